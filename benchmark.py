@@ -0,0 +1,82 @@
+import sys
+import time
+
+import numpy
+
+from geodesy import LocalProjection
+from particlefilter import ParticleFilter
+from pathloss import predict
+from triangulation import getStrongestPoint, getVoronaiPoints, groupSites
+
+PARTICLES = 10000
+STATIONS = 100
+TARGET_UPDATES = 20.0
+SITES = 2000
+
+
+def timeIt(function, repeat):
+	function()
+	start = time.time()
+	for _ in range(repeat):
+		function()
+	return (time.time() - start) / repeat
+
+
+def benchmarkParticleFilter(repeat=20):
+	random = numpy.random.RandomState(0)
+	planar = random.uniform(-80, 80, (STATIONS, 2))
+	distanceSquared = ((planar - [5.0, -3.0]) ** 2).sum(axis=1)
+	sigStrength = predict(distanceSquared, gain=-30) + random.normal(0, 6, STATIONS)
+	erp = numpy.zeros(STATIONS)
+	exponent = numpy.full(STATIONS, 2.7)
+
+	particles = ParticleFilter(LocalProjection(41.9, -87.7), PARTICLES, seed=0)
+	particles.spread([-100, -100], [100, 100])
+
+	def step():
+		particles.predict()
+		particles.update(planar, sigStrength, erp, exponent)
+
+	seconds = timeIt(step, repeat)
+	print('particle filter: %d particles x %d stations, %.1f ms/update, %.1f updates/s'
+		  % (PARTICLES, STATIONS, seconds * 1000, 1 / seconds))
+	return 1 / seconds >= TARGET_UPDATES
+
+
+# The per-simplex loop getStrongestPoint() used to be, with its indexing fixed
+def loopStrongestPoint(voronaiPoints, simplices, stations):
+	sigStrength = [station['SignalStrength'] for station in groupSites(stations)]
+	maxPower = None
+	maxIndex = 0
+	for (index, simple) in enumerate(simplices):
+		sigPower = (sigStrength[simple[0]] + sigStrength[simple[1]] + sigStrength[simple[2]]) / 3
+		if maxPower is None or sigPower > maxPower:
+			maxPower = sigPower
+			maxIndex = index
+	(lat, lng) = voronaiPoints[maxIndex]
+	return (lat, lng)
+
+
+def benchmarkStrongestPoint(repeat=5):
+	random = numpy.random.RandomState(0)
+	coordinates = numpy.column_stack((random.uniform(41, 43, SITES), random.uniform(-89, -87, SITES)))
+	stations = [{'Coordinates': [lat, lng], 'SignalStrength': float(signal)}
+				for ((lat, lng), signal) in zip(coordinates.tolist(), random.uniform(-90, -30, SITES))]
+	(voronaiPts, simplices, coordinates) = getVoronaiPoints(stations)
+	simplexList = simplices.tolist()
+
+	expected = loopStrongestPoint(voronaiPts, simplexList, stations)
+	if tuple(getStrongestPoint(voronaiPts, simplices, stations)) != tuple(expected):
+		print('strongest point: vectorized result differs from the loop')
+		return False
+
+	loop = timeIt(lambda: loopStrongestPoint(voronaiPts, simplexList, stations), repeat)
+	vectorized = timeIt(lambda: getStrongestPoint(voronaiPts, simplices, stations), repeat)
+	print('strongest point: %d sites, %d simplices, loop %.2f ms, vectorized %.2f ms'
+		  % (SITES, len(simplices), loop * 1000, vectorized * 1000))
+	return True
+
+
+if __name__ == '__main__':
+	results = [benchmarkParticleFilter(), benchmarkStrongestPoint()]
+	sys.exit(0 if all(results) else 1)
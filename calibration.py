@@ -0,0 +1,171 @@
+import os
+
+import numpy
+
+from geodesy import distance
+from pathloss import DEFAULT_ERP, DEFAULT_EXPONENT, DEFAULT_SIGMA_DB, REFERENCE_KM, effectiveDistanceSquared
+from snapshot import atomicWrite
+from stations import STATIONS_FILE, getStations
+
+# One reading of a station from a receiver at a surveyed position
+SURVEY = numpy.dtype([('epoch', 'i8'), ('station', 'i8'), ('rssi', 'f8'),
+					  ('latitude', 'f8'), ('longitude', 'f8')])
+
+SUFFIX = '.cal.npz'
+MIN_OBSERVATIONS = 5
+# Spread of the exponent prior. A station only heard over a narrow range of
+# distances cannot separate ERP from exponent, so the fit leans on the prior.
+EXPONENT_SIGMA = 0.5
+# Epochs hearing fewer stations than this do not get a receiver gain of their own
+MIN_GAIN_STATIONS = 3
+GAIN_ITERATIONS = 5
+
+
+def calibrationPath(csvPath):
+	return csvPath + SUFFIX
+
+
+# Fitted ERP and exponent per station row; NaN where a row is uncalibrated.
+# Lives in store.indexes, so rows touched by a delta lose their calibration.
+class Calibration(object):
+
+	def __init__(self, store, erp=None, exponent=None, count=None, rms=None):
+		self.store = store
+		length = len(store)
+		self.erp = numpy.full(length, numpy.nan) if erp is None else erp
+		self.exponent = numpy.full(length, numpy.nan) if exponent is None else exponent
+		self.count = numpy.zeros(length, dtype=numpy.int64) if count is None else count
+		self.rms = numpy.full(length, numpy.nan) if rms is None else rms
+
+	def _grow(self):
+		length = len(self.store)
+		for name in ('erp', 'exponent', 'count', 'rms'):
+			column = getattr(self, name)
+			if len(column) < length:
+				grown = numpy.full(length, 0 if name == 'count' else numpy.nan, dtype=column.dtype)
+				grown[:len(column)] = column
+				setattr(self, name, grown)
+
+	def update(self, changed, deleted):
+		self._grow()
+		for rows in (changed, deleted):
+			self.erp[rows] = numpy.nan
+			self.exponent[rows] = numpy.nan
+			self.count[rows] = 0
+			self.rms[rows] = numpy.nan
+
+	def calibrated(self):
+		return numpy.flatnonzero(~numpy.isnan(self.erp))
+
+	def parameters(self, rows):
+		self._grow()
+		rows = numpy.asarray(rows, dtype=numpy.intp)
+		erp = self.erp[rows]
+		exponent = self.exponent[rows]
+		return (numpy.where(numpy.isnan(erp), DEFAULT_ERP, erp),
+				numpy.where(numpy.isnan(exponent), DEFAULT_EXPONENT, exponent))
+
+	# Sets 'Erp' and 'Exponent' on station dicts of calibrated rows, which is
+	# where stationParameters() looks for them
+	def annotate(self, stations):
+		self._grow()
+		for station in stations:
+			row = station.get('Row')
+			if row is not None and not numpy.isnan(self.erp[row]):
+				station['Erp'] = float(self.erp[row])
+				station['Exponent'] = float(self.exponent[row])
+		return stations
+
+
+def _solve(stationIds, x, sigStrength, count, priorWeight):
+	# Normal equations of rssi = erp - exponent * x for every station at once,
+	# with a ridge term pulling the exponent towards DEFAULT_EXPONENT
+	n = numpy.bincount(stationIds, minlength=count).astype(numpy.float64)
+	sx = numpy.bincount(stationIds, x, count)
+	sxx = numpy.bincount(stationIds, x * x, count) + priorWeight
+	sy = numpy.bincount(stationIds, sigStrength, count)
+	sxy = numpy.bincount(stationIds, x * sigStrength, count) - priorWeight * DEFAULT_EXPONENT
+	determinant = n * sxx - sx * sx
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		erp = (sxx * sy - sx * sxy) / determinant
+		exponent = (sx * sy - n * sxy) / determinant
+	return (erp, exponent)
+
+
+# observations is a SURVEY array. Each reading's receiver gain is unknown, so
+# station parameters and a gain per epoch are fitted in turn; the gains are
+# kept at zero mean, which ties the ERPs to the receiver's average level.
+def fitCalibration(observations, store=None, minObservations=MIN_OBSERVATIONS, sigma=DEFAULT_SIGMA_DB,
+				   exponentSigma=EXPONENT_SIGMA, fitGain=True, iterations=GAIN_ITERATIONS):
+	store = store or getStations()
+	observations = numpy.asarray(observations)
+	stationIds = observations['station'].astype(numpy.intp)
+	sigStrength = observations['rssi'].astype(numpy.float64)
+	distanceKm = distance(observations['latitude'], observations['longitude'],
+						  store.latitude[stationIds], store.longitude[stationIds])
+	x = 5 * numpy.log10(effectiveDistanceSquared(distanceKm ** 2) / REFERENCE_KM ** 2)
+	priorWeight = (sigma / exponentSigma) ** 2
+
+	(epochs, epochIds) = numpy.unique(observations['epoch'], return_inverse=True)
+	epochIds = epochIds.ravel()
+	epochCounts = numpy.bincount(epochIds, minlength=len(epochs))
+	solvable = epochCounts >= MIN_GAIN_STATIONS
+	gain = numpy.zeros(len(epochs))
+	count = len(store)
+
+	for iteration in range(iterations if fitGain else 1):
+		(erp, exponent) = _solve(stationIds, x, sigStrength - gain[epochIds], count, priorWeight)
+		if not fitGain or not solvable.any():
+			break
+		residual = sigStrength - erp[stationIds] + exponent[stationIds] * x
+		gain = numpy.bincount(epochIds, residual, len(epochs)) / numpy.maximum(epochCounts, 1)
+		gain[~solvable] = 0
+		gain[solvable] -= numpy.average(gain[solvable], weights=epochCounts[solvable])
+	else:
+		(erp, exponent) = _solve(stationIds, x, sigStrength - gain[epochIds], count, priorWeight)
+
+	residual = sigStrength - gain[epochIds] - erp[stationIds] + exponent[stationIds] * x
+	observed = numpy.bincount(stationIds, minlength=count)
+	rms = numpy.sqrt(numpy.bincount(stationIds, residual ** 2, count) / numpy.maximum(observed, 1))
+	fitted = (observed >= minObservations) & numpy.isfinite(erp) & numpy.isfinite(exponent)
+	return Calibration(store, numpy.where(fitted, erp, numpy.nan), numpy.where(fitted, exponent, numpy.nan),
+					   numpy.where(fitted, observed, 0), numpy.where(fitted, rms, numpy.nan))
+
+
+# Rows are stored with their callsign and channel, so a calibration survives
+# a snapshot rebuild that renumbers the stations
+def saveCalibration(calibration, path=STATIONS_FILE):
+	store = calibration.store
+	rows = calibration.calibrated()
+	target = calibrationPath(os.path.abspath(path))
+	with atomicWrite(target) as fobj:
+		numpy.savez(fobj, rows=rows, erp=calibration.erp[rows], exponent=calibration.exponent[rows],
+					count=calibration.count[rows], rms=calibration.rms[rows],
+					callsign=store.decode(store.callsign[rows]).astype('U'),
+					frequency=store.frequency[rows])
+	return target
+
+
+def loadCalibration(store=None, path=STATIONS_FILE):
+	path = os.path.abspath(path)
+	store = store or getStations(path)
+	calibration = Calibration(store)
+	target = calibrationPath(path)
+	if not os.path.exists(target):
+		return calibration
+
+	with numpy.load(target) as saved:
+		rows = store.relocate(saved['rows'], saved['callsign'].tolist(), saved['frequency'])
+		found = rows >= 0
+		rows = rows[found]
+		for name in ('erp', 'exponent', 'count', 'rms'):
+			getattr(calibration, name)[rows] = saved[name][found]
+	return calibration
+
+
+def getCalibration(store=None, path=STATIONS_FILE):
+	store = store or getStations(path)
+	calibration = store.indexes.get('calibration')
+	if calibration is None:
+		calibration = store.indexes['calibration'] = loadCalibration(store, path)
+	return calibration
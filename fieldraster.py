@@ -0,0 +1,241 @@
+import os
+import struct
+import sys
+
+import numpy
+
+from geodesy import EARTH_RADIUS_KM, distance
+from indexes import inBounds
+from pathloss import DEFAULT_ERP, DEFAULT_EXPONENT, predict
+from snapshot import atomicWrite
+from stations import STATIONS_FILE, getStations
+
+# Layout: header | tiles of TILE_CELLS x TILE_CELLS uint8 levels | tile
+# directory | station table. Tiles are quantized on their own range rather
+# than entropy coded, so any cell stays one mmap read away.
+MAGIC = b'FMRAST\x00\x01'
+HEADER = struct.Struct('<8sdI4xQQQ')
+TILE = numpy.dtype([('key', '<i8'), ('low', '<f4'), ('scale', '<f4')])
+STATION = numpy.dtype([('row', '<i8'), ('latitude', '<f8'), ('longitude', '<f8')])
+NODATA = 255
+LEVELS = 254
+
+SUFFIX = '.raster'
+# One arc minute cells in one degree tiles
+RESOLUTION_DEG = 1 / 60.0
+TILE_CELLS = 60
+DEFAULT_RADIUS_KM = 100.0
+
+
+class RasterError(Exception):
+	pass
+
+
+def rasterPath(csvPath):
+	return csvPath + SUFFIX
+
+
+def _key(row, tileY, tileX):
+	return (int(row) << 32) | (int(tileY) << 16) | int(tileX)
+
+
+def _stationTiles(lat, lon, erp, exponent, radiusKm, resolution, tile):
+	latTiles = int(numpy.ceil(180 / resolution / tile))
+	lonTiles = int(round(360 / resolution / tile))
+	dLat = numpy.degrees(radiusKm / EARTH_RADIUS_KM)
+	dLon = min(dLat / max(numpy.cos(numpy.radians(lat)), 1e-3), 180)
+	tileYs = numpy.arange(max(int((lat - dLat + 90) / resolution) // tile, 0),
+						  min(int((lat + dLat + 90) / resolution) // tile, latTiles - 1) + 1)
+	tileXs = numpy.arange(int(numpy.floor((lon - dLon + 180) / resolution)) // tile,
+						  int(numpy.floor((lon + dLon + 180) / resolution)) // tile + 1)[:lonTiles]
+
+	cellLat = (tileYs[:, None] * tile + numpy.arange(tile) + 0.5).ravel() * resolution - 90
+	cellLon = (tileXs[:, None] * tile + numpy.arange(tile) + 0.5).ravel() * resolution - 180
+	(gridLat, gridLon) = numpy.meshgrid(cellLat, cellLon, indexing='ij')
+	distanceKm = distance(lat, lon, gridLat, gridLon)
+	level = predict(distanceKm ** 2, erp, exponent)
+	inside = (distanceKm <= radiusKm) & (gridLat <= 90)
+
+	shape = (len(tileYs), tile, len(tileXs), tile)
+	level = level.reshape(shape).transpose(0, 2, 1, 3)
+	inside = inside.reshape(shape).transpose(0, 2, 1, 3)
+	for (y, x) in zip(*numpy.nonzero(inside.any(axis=(2, 3)))):
+		values = level[y, x]
+		mask = inside[y, x]
+		low = values[mask].min()
+		scale = max((values[mask].max() - low) / LEVELS, 1e-6)
+		codes = numpy.where(mask, numpy.rint((values - low) / scale), NODATA).astype(numpy.uint8)
+		yield (tileYs[y], tileXs[x] % lonTiles, low, scale, codes)
+
+
+# Offline job: predicted level of every selected station on every cell within
+# radiusKm of it. rows defaults to all live stations, optionally limited to
+# bounds (south, west, north, east); calibration supplies fitted parameters.
+def buildRasters(path=STATIONS_FILE, store=None, rows=None, bounds=None, calibration=None,
+				 radiusKm=DEFAULT_RADIUS_KM, resolution=RESOLUTION_DEG, tile=TILE_CELLS):
+	path = os.path.abspath(path)
+	store = store or getStations(path)
+	if abs(360 / resolution / tile - round(360 / resolution / tile)) > 1e-9:
+		raise RasterError('%d cell tiles do not divide the globe at %g degrees' % (tile, resolution))
+	rows = numpy.flatnonzero(store.alive) if rows is None else numpy.unique(numpy.asarray(rows, dtype=numpy.intp))
+	if bounds is not None:
+		rows = rows[inBounds(store, rows, bounds)]
+	if calibration is None:
+		(erp, exponent) = (numpy.full(len(rows), DEFAULT_ERP), numpy.full(len(rows), DEFAULT_EXPONENT))
+	else:
+		(erp, exponent) = calibration.parameters(rows)
+
+	target = rasterPath(path)
+	directory = []
+	with atomicWrite(target) as fobj:
+		fobj.write(b'\0' * HEADER.size)
+		for (row, stationErp, stationExponent) in zip(rows.tolist(), erp.tolist(), exponent.tolist()):
+			for (tileY, tileX, low, scale, codes) in _stationTiles(store.latitude[row], store.longitude[row],
+																   stationErp, stationExponent,
+																   radiusKm, resolution, tile):
+				directory.append((_key(row, tileY, tileX), low, scale))
+				fobj.write(codes.tobytes())
+		# Directory entries stay in data order, grouped by row
+		tiles = numpy.array(directory, dtype=TILE)
+		stations = numpy.zeros(len(rows), dtype=STATION)
+		stations['row'] = rows
+		stations['latitude'] = store.latitude[rows]
+		stations['longitude'] = store.longitude[rows]
+
+		directoryOffset = fobj.tell()
+		fobj.write(tiles.tobytes())
+		fobj.write(stations.tobytes())
+		fobj.seek(0)
+		fobj.write(HEADER.pack(MAGIC, resolution, tile, len(tiles), directoryOffset, len(stations)))
+	return target
+
+
+class FieldRasters(object):
+
+	def __init__(self, path, store):
+		self.store = store
+		with open(path, 'rb') as fobj:
+			header = fobj.read(HEADER.size)
+			if len(header) < HEADER.size:
+				raise RasterError('%s is truncated' % path)
+			(magic, self.resolution, self.tile, tileCount, directoryOffset, stationCount) = HEADER.unpack(header)
+			if magic != MAGIC:
+				raise RasterError('%s is not a raster file' % path)
+			fobj.seek(directoryOffset)
+			tiles = numpy.fromfile(fobj, dtype=TILE, count=tileCount)
+			stations = numpy.fromfile(fobj, dtype=STATION, count=stationCount)
+		if len(tiles) != tileCount or len(stations) != stationCount:
+			raise RasterError('%s is truncated' % path)
+
+		# Slot -1 picks the trailing NaN entry
+		self.low = numpy.append(tiles['low'].astype(numpy.float64), numpy.nan)
+		self.scale = numpy.append(tiles['scale'].astype(numpy.float64), numpy.nan)
+		if tileCount:
+			self.cells = numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=HEADER.size,
+									  shape=(tileCount * self.tile * self.tile,))
+		else:
+			self.cells = numpy.full(self.tile * self.tile, NODATA, dtype=numpy.uint8)
+		self.latCells = int(numpy.ceil(180 / self.resolution / self.tile)) * self.tile
+		self.lonCells = int(round(360 / self.resolution))
+		self._indexTiles(tiles['key'])
+
+		# A station only uses its raster while it still sits where the raster was computed
+		self.valid = numpy.zeros(len(store), dtype=bool)
+		rows = stations['row'].astype(numpy.intp)
+		rows = rows[rows < len(store)]
+		same = (store.latitude[rows] == stations['latitude'][:len(rows)]) & \
+			   (store.longitude[rows] == stations['longitude'][:len(rows)])
+		self.valid[rows[same & store.alive[rows]]] = True
+
+	# Every station's tiles lie in a small box, so each gets a dense grid of
+	# tile slots (-1 where a tile is empty) and a lookup is plain indexing
+	def _indexTiles(self, keys):
+		lonTiles = self.lonCells // self.tile
+		tileRows = keys >> 32
+		tileY = (keys >> 16) & 0xFFFF
+		tileX = keys & 0xFFFF
+		(stationRows, starts) = numpy.unique(tileRows, return_index=True)
+		group = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.append(starts, len(keys))))
+		if len(keys):
+			wraps = numpy.maximum.reduceat(tileX, starts) - numpy.minimum.reduceat(tileX, starts) > lonTiles // 2
+			tileX = numpy.where(wraps[group] & (tileX < lonTiles // 2), tileX + lonTiles, tileX)
+
+		length = int(stationRows.max()) + 1 if len(stationRows) else 0
+		self.boxes = numpy.zeros((length, 5), dtype=numpy.int32)
+		if not len(keys):
+			self.slots = numpy.full(1, -1, dtype=numpy.int32)
+			return
+		y0 = numpy.minimum.reduceat(tileY, starts)
+		x0 = numpy.minimum.reduceat(tileX, starts)
+		height = numpy.maximum.reduceat(tileY, starts) - y0 + 1
+		width = numpy.maximum.reduceat(tileX, starts) - x0 + 1
+		bases = numpy.cumsum(height * width) - height * width
+		self.boxes[stationRows] = numpy.column_stack((y0, x0, height, width, bases))
+		self.slots = numpy.full(int((height * width).sum()), -1, dtype=numpy.int32)
+		self.slots[bases[group] + (tileY - y0[group]) * width[group] + tileX - x0[group]] = numpy.arange(len(keys))
+
+	def update(self, changed, deleted):
+		if len(self.valid) < len(self.store):
+			grown = numpy.zeros(len(self.store), dtype=bool)
+			grown[:len(self.valid)] = self.valid
+			self.valid = grown
+		self.valid[changed] = False
+		self.valid[deleted] = False
+
+	def _cells(self, boxes, cellY, cellX):
+		(y0, x0, height, width, bases) = boxes
+		tileY = cellY // self.tile - y0
+		tileX = (cellX // self.tile - x0) % (self.lonCells // self.tile)
+		inside = (tileY >= 0) & (tileY < height) & (tileX < width)
+		slots = self.slots[numpy.where(inside, bases + tileY * width + tileX, 0)]
+		found = slots >= 0
+		found &= inside
+		cells = self.tile * (cellY % self.tile) + cellX % self.tile
+		codes = self.cells[numpy.where(found, slots, 0).astype(numpy.intp) * self.tile ** 2 + cells]
+		found &= codes != NODATA
+		slots[~found] = -1
+		return numpy.where(found, self.low[slots] + codes * self.scale[slots], numpy.nan)
+
+	# Predicted level of each station row at each (lat, lon), bilinearly
+	# interpolated between cell centers; shape (points, rows). NaN where a
+	# station has no raster coverage.
+	def lookup(self, rows, lat, lon):
+		rows = numpy.asarray(rows, dtype=numpy.int64)
+		valid = numpy.zeros(len(rows), dtype=bool)
+		known = (rows < len(self.valid)) & (rows < len(self.boxes))
+		valid[known] = self.valid[rows[known]]
+		boxes = numpy.zeros((5, len(rows)), dtype=numpy.int32)
+		boxes[:, valid] = self.boxes[rows[valid]].T
+
+		y = (numpy.asarray(lat, dtype=numpy.float64)[:, None] + 90) / self.resolution - 0.5
+		x = (numpy.asarray(lon, dtype=numpy.float64)[:, None] + 180) / self.resolution - 0.5
+		y = numpy.clip(y, 0, self.latCells - 1)
+		cellY = numpy.minimum(numpy.floor(y), self.latCells - 2)
+		cellX = numpy.floor(x)
+		(wy, wx) = (y - cellY, x - cellX)
+		cellY = cellY.astype(numpy.int32)
+		cellX = (cellX % self.lonCells).astype(numpy.int32)
+		nextX = (cellX + 1) % self.lonCells
+
+		level = (self._cells(boxes, cellY, cellX) * ((1 - wy) * (1 - wx)) +
+				 self._cells(boxes, cellY, nextX) * ((1 - wy) * wx) +
+				 self._cells(boxes, cellY + 1, cellX) * (wy * (1 - wx)) +
+				 self._cells(boxes, cellY + 1, nextX) * (wy * wx))
+		level[:, ~valid] = numpy.nan
+		return level
+
+
+def getFieldRasters(store=None, path=STATIONS_FILE):
+	path = os.path.abspath(path)
+	store = store or getStations(path)
+	rasters = store.indexes.get('rasters')
+	if rasters is None:
+		if not os.path.exists(rasterPath(path)):
+			return None
+		rasters = store.indexes['rasters'] = FieldRasters(rasterPath(path), store)
+	return rasters
+
+
+if __name__ == '__main__':
+	bounds = tuple(float(value) for value in sys.argv[1:5]) if len(sys.argv) >= 5 else None
+	print(buildRasters(bounds=bounds))
@@ -0,0 +1,168 @@
+import os
+
+import numpy
+from scipy import sparse
+
+from geodesy import zoneProjection
+from snapshot import atomicWrite
+from stations import STATIONS_FILE, getStations
+
+SUFFIX = '.fp.npz'
+# Level assumed for a station missing from a scan or a fingerprint. Vectors
+# are stored relative to it, so the Euclidean distance over the union of
+# heard stations reduces to sparse dot products.
+MISSING_DB = -100.0
+DEFAULT_NEIGHBOURS = 4
+MIN_SHARED = 1
+
+
+def fingerprintPath(csvPath):
+	return csvPath + SUFFIX
+
+
+# One sparse signal-strength vector per surveyed position, with a column per
+# station row. The CSC copy is the inverted index from a station to the
+# fingerprints that heard it.
+class FingerprintDatabase(object):
+
+	def __init__(self, store, levels=None, latitude=None, longitude=None):
+		self.store = store
+		if levels is None:
+			levels = sparse.csr_matrix((0, len(store)), dtype=numpy.float32)
+		self.levels = levels
+		self.latitude = numpy.empty(0) if latitude is None else latitude
+		self.longitude = numpy.empty(0) if longitude is None else longitude
+		self._refresh()
+
+	def __len__(self):
+		return self.levels.shape[0]
+
+	def _refresh(self):
+		self.norms = numpy.asarray(self.levels.multiply(self.levels).sum(axis=1), dtype=numpy.float64).ravel()
+		self.inverted = self.levels.tocsc()
+
+	# Readings keep their columns across deltas; a station that moved simply
+	# stops agreeing with the fingerprints taken before
+	def update(self, changed, deleted):
+		pass
+
+	# observations is a calibration.SURVEY array; each epoch becomes one
+	# fingerprint at the mean of its positions, keeping the strongest reading
+	# of a station heard more than once
+	def add(self, observations):
+		observations = numpy.asarray(observations)
+		if not len(observations):
+			return
+		order = numpy.lexsort((observations['rssi'], observations['station'], observations['epoch']))
+		observations = observations[order]
+		last = numpy.ones(len(observations), dtype=bool)
+		last[:-1] = (observations['epoch'][1:] != observations['epoch'][:-1]) | \
+					(observations['station'][1:] != observations['station'][:-1])
+		observations = observations[last]
+
+		(epochs, epochIds) = numpy.unique(observations['epoch'], return_inverse=True)
+		epochIds = epochIds.ravel()
+		counts = numpy.bincount(epochIds, minlength=len(epochs))
+		latitude = numpy.bincount(epochIds, observations['latitude'], len(epochs)) / counts
+		longitude = numpy.bincount(epochIds, observations['longitude'], len(epochs)) / counts
+
+		columns = max(self.levels.shape[1], len(self.store), int(observations['station'].max()) + 1)
+		levels = numpy.maximum(observations['rssi'] - MISSING_DB, 0).astype(numpy.float32)
+		added = sparse.csr_matrix((levels, (epochIds, observations['station'].astype(numpy.intp))),
+								  shape=(len(epochs), columns))
+		existing = self.levels
+		if existing.shape[1] < columns:
+			existing = sparse.csr_matrix((existing.data, existing.indices, existing.indptr),
+										 shape=(existing.shape[0], columns))
+		self.levels = sparse.vstack((existing, added), format='csr')
+		self.levels.eliminate_zeros()
+		self.latitude = numpy.concatenate((self.latitude, latitude))
+		self.longitude = numpy.concatenate((self.longitude, longitude))
+		self._refresh()
+
+	# k fingerprints nearest to a scan, by Euclidean distance in dB with
+	# MISSING_DB standing in for unheard stations. Only fingerprints sharing
+	# at least minShared stations with the scan are considered.
+	def match(self, rows, sigStrength, k=DEFAULT_NEIGHBOURS, minShared=MIN_SHARED):
+		rows = numpy.asarray(rows, dtype=numpy.intp)
+		levels = numpy.maximum(numpy.asarray(sigStrength, dtype=numpy.float64) - MISSING_DB, 0)
+		scanNorm = levels.dot(levels)
+		known = rows < self.levels.shape[1]
+		heard = self.inverted[:, rows[known]]
+
+		shared = heard.getnnz(axis=1)
+		candidates = numpy.flatnonzero(shared >= max(minShared, 1))
+		heard = heard[candidates]
+		distanceSquared = self.norms[candidates] + scanNorm - 2 * heard.dot(levels[known])
+		distances = numpy.sqrt(numpy.maximum(distanceSquared, 0))
+		if len(candidates) > k:
+			nearest = numpy.argpartition(distances, k - 1)[:k]
+			(candidates, distances) = (candidates[nearest], distances[nearest])
+		order = numpy.argsort(distances, kind='stable')
+		return (candidates[order], distances[order])
+
+
+def locate(stations, database=None, k=DEFAULT_NEIGHBOURS, minShared=MIN_SHARED):
+	if database is None:
+		database = getFingerprints()
+	rows = [station['Row'] for station in stations]
+	sigStrength = [station['SignalStrength'] for station in stations]
+	(neighbours, distances) = database.match(rows, sigStrength, k, minShared)
+	if not len(neighbours):
+		raise ValueError('no fingerprint shares a station with the scan')
+
+	projection = zoneProjection(database.latitude[neighbours[0]], database.longitude[neighbours[0]])
+	planar = numpy.column_stack(projection.forward(database.latitude[neighbours], database.longitude[neighbours]))
+	weights = 1 / (distances + 1e-3)
+	weights /= weights.sum()
+	mean = weights.dot(planar)
+	deviation = planar - mean
+	(lat, lng) = projection.inverse(mean[0], mean[1])
+	return {'Coordinates': [float(lat), float(lng)],
+			'Covariance': (weights[:, None] * deviation).T.dot(deviation),
+			'Neighbours': neighbours,
+			'Distance': float(distances[0])}
+
+
+def saveFingerprints(database, path=STATIONS_FILE):
+	store = database.store
+	levels = database.levels.tocsr()
+	(columns, indices) = numpy.unique(levels.indices, return_inverse=True)
+	known = columns < len(store)
+	callsigns = numpy.full(len(columns), '', dtype=object)
+	callsigns[known] = store.decode(store.callsign[columns[known]])
+	channels = numpy.zeros(len(columns), dtype=numpy.int32)
+	channels[known] = store.frequency[columns[known]]
+
+	target = fingerprintPath(os.path.abspath(path))
+	with atomicWrite(target) as fobj:
+		numpy.savez(fobj, data=levels.data, indices=indices.astype(numpy.int32), indptr=levels.indptr,
+					columns=columns, callsign=callsigns.astype('U'), frequency=channels,
+					latitude=database.latitude, longitude=database.longitude)
+	return target
+
+
+def loadFingerprints(store=None, path=STATIONS_FILE):
+	path = os.path.abspath(path)
+	store = store or getStations(path)
+	target = fingerprintPath(path)
+	if not os.path.exists(target):
+		return FingerprintDatabase(store)
+
+	with numpy.load(target) as saved:
+		columns = store.relocate(saved['columns'], saved['callsign'].tolist(), saved['frequency'])
+		indices = columns[saved['indices']]
+		data = numpy.where(indices >= 0, saved['data'], 0)
+		shape = (len(saved['indptr']) - 1, max(len(store), int(columns.max(initial=-1)) + 1))
+		levels = sparse.csr_matrix((data, numpy.maximum(indices, 0), saved['indptr']), shape=shape)
+		levels.sum_duplicates()
+		levels.eliminate_zeros()
+		return FingerprintDatabase(store, levels, saved['latitude'], saved['longitude'])
+
+
+def getFingerprints(store=None, path=STATIONS_FILE):
+	store = store or getStations(path)
+	database = store.indexes.get('fingerprints')
+	if database is None:
+		database = store.indexes['fingerprints'] = loadFingerprints(store, path)
+	return database
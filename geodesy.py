@@ -0,0 +1,122 @@
+import numpy
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def toCartesian(lat, lon):
+	lat = numpy.radians(numpy.asarray(lat, dtype=numpy.float64))
+	lon = numpy.radians(numpy.asarray(lon, dtype=numpy.float64))
+	cosLat = numpy.cos(lat)
+	return numpy.stack((cosLat * numpy.cos(lon), cosLat * numpy.sin(lon), numpy.sin(lat)), axis=-1) * EARTH_RADIUS_KM
+
+
+def distance(lat1, lon1, lat2, lon2):
+	lat1 = numpy.radians(lat1)
+	lat2 = numpy.radians(lat2)
+	dLat = lat2 - lat1
+	dLon = numpy.radians(numpy.subtract(lon2, lon1))
+	h = numpy.sin(dLat / 2) ** 2 + numpy.cos(lat1) * numpy.cos(lat2) * numpy.sin(dLon / 2) ** 2
+	return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1.0)))
+
+
+def bearing(lat1, lon1, lat2, lon2):
+	lat1 = numpy.radians(lat1)
+	lat2 = numpy.radians(lat2)
+	dLon = numpy.radians(numpy.subtract(lon2, lon1))
+	y = numpy.sin(dLon) * numpy.cos(lat2)
+	x = numpy.cos(lat1) * numpy.sin(lat2) - numpy.sin(lat1) * numpy.cos(lat2) * numpy.cos(dLon)
+	return numpy.degrees(numpy.arctan2(y, x)) % 360
+
+
+# Per-point terms for the pairwise kernels below. Expanding sin((a - b) / 2)
+# and sin(a - b) into products of per-point sines and cosines leaves only
+# multiplies and adds in the N x M inner loop.
+def _terms(points, dtype):
+	points = numpy.radians(numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2))
+	(lat, lon) = (points[:, 0], points[:, 1])
+	return dict((name, value.astype(dtype)) for (name, value) in (
+		('sinHalfLat', numpy.sin(lat / 2)), ('cosHalfLat', numpy.cos(lat / 2)),
+		('sinHalfLon', numpy.sin(lon / 2)), ('cosHalfLon', numpy.cos(lon / 2)),
+		('sinLat', numpy.sin(lat)), ('cosLat', numpy.cos(lat)),
+		('sinLon', numpy.sin(lon)), ('cosLon', numpy.cos(lon))))
+
+
+def _distanceKernel(a, b):
+	sinHalfDLat = a['sinHalfLat'][:, None] * b['cosHalfLat'] - a['cosHalfLat'][:, None] * b['sinHalfLat']
+	sinHalfDLon = a['sinHalfLon'][:, None] * b['cosHalfLon'] - a['cosHalfLon'][:, None] * b['sinHalfLon']
+	h = sinHalfDLat ** 2 + (a['cosLat'][:, None] * b['cosLat']) * sinHalfDLon ** 2
+	return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(h, 1)))
+
+
+def _bearingKernel(a, b):
+	sinDLon = b['sinLon'] * a['cosLon'][:, None] - b['cosLon'] * a['sinLon'][:, None]
+	cosDLon = b['cosLon'] * a['cosLon'][:, None] + b['sinLon'] * a['sinLon'][:, None]
+	y = sinDLon * b['cosLat']
+	x = a['cosLat'][:, None] * b['sinLat'] - (a['sinLat'][:, None] * b['cosLat']) * cosDLon
+	return numpy.degrees(numpy.arctan2(y, x)) % 360
+
+
+def _pairwise(kernel, receivers, stations, dtype, chunkSize, out):
+	a = _terms(receivers, dtype)
+	b = _terms(stations, dtype)
+	n = len(a['sinLat'])
+	if out is None:
+		out = numpy.empty((n, len(b['sinLat'])), dtype=dtype)
+	step = n if chunkSize is None else max(1, chunkSize)
+	for start in range(0, n, step):
+		chunk = dict((name, value[start:start + step]) for (name, value) in a.items())
+		out[start:start + step] = kernel(chunk, b)
+	return out
+
+
+# receivers and stations are sequences of [lat, lon] pairs in degrees; the
+# result has one row per receiver. chunkSize bounds the number of receiver
+# rows evaluated at once, which caps the size of the temporaries.
+def distanceMatrix(receivers, stations, dtype=numpy.float64, chunkSize=None, out=None):
+	return _pairwise(_distanceKernel, receivers, stations, dtype, chunkSize, out)
+
+
+def bearingMatrix(receivers, stations, dtype=numpy.float64, chunkSize=None, out=None):
+	return _pairwise(_bearingKernel, receivers, stations, dtype, chunkSize, out)
+
+
+# East/north coordinates in km on the plane tangent to the sphere at
+# (lat0, lon0). Heights above the plane are dropped, which inverse() undoes
+# exactly by putting the point back on the sphere.
+class LocalProjection(object):
+
+	def __init__(self, lat0, lon0):
+		self.origin = (float(lat0), float(lon0))
+		(lat, lon) = numpy.radians(self.origin)
+		self.center = toCartesian(lat0, lon0)
+		self.axes = numpy.array([[-numpy.sin(lon), numpy.cos(lon), 0],
+								 [-numpy.sin(lat) * numpy.cos(lon), -numpy.sin(lat) * numpy.sin(lon), numpy.cos(lat)],
+								 [numpy.cos(lat) * numpy.cos(lon), numpy.cos(lat) * numpy.sin(lon), numpy.sin(lat)]])
+
+	def forward(self, lat, lon):
+		local = (toCartesian(lat, lon) - self.center).dot(self.axes[:2].T)
+		return (local[..., 0], local[..., 1])
+
+	def inverse(self, east, north):
+		east = numpy.asarray(east, dtype=numpy.float64)
+		north = numpy.asarray(north, dtype=numpy.float64)
+		up = numpy.sqrt(numpy.maximum(EARTH_RADIUS_KM ** 2 - east ** 2 - north ** 2, 0)) - EARTH_RADIUS_KM
+		point = self.center + numpy.stack((east, north, up), axis=-1).dot(self.axes)
+		lat = numpy.degrees(numpy.arcsin(numpy.clip(point[..., 2] / EARTH_RADIUS_KM, -1, 1)))
+		lon = numpy.degrees(numpy.arctan2(point[..., 1], point[..., 0]))
+		return (lat, lon)
+
+
+ZONE_DEGREES = 6.0
+
+_zones = {}
+
+
+# Fixes that fall in the same ZONE_DEGREES cell share one tangent plane, so
+# projected station coordinates can be cached per zone
+def zoneProjection(lat, lon, size=ZONE_DEGREES):
+	key = (int(numpy.floor(lat / size)), int(numpy.floor(lon / size)), size)
+	projection = _zones.get(key)
+	if projection is None:
+		projection = _zones[key] = LocalProjection((key[0] + 0.5) * size, (key[1] + 0.5) * size)
+	return projection
@@ -0,0 +1,106 @@
+import numpy
+
+from multilateration import getScanProjection, getInitialGuess
+from pathloss import DEFAULT_SIGMA_DB, predict, stationParameters
+from triangulation import getPlanarCoordinates
+
+DEFAULT_RESOLUTION_KM = 0.1
+DEFAULT_MARGIN_KM = 50.0
+DEFAULT_CELLS = 64
+# Weak Gaussian prior around the signal-weighted centroid. It only matters
+# when the signal strengths cannot pin down a point, e.g. with one or two
+# stations, where every cell on a circle fits equally well.
+DEFAULT_PRIOR_KM = 100.0
+DEFAULT_MEMORY_BYTES = 32 << 20
+
+# float64 temporaries alive per (cell, station) pair while evaluating a chunk
+_TEMPORARIES = 4
+
+
+def _predict(chunk, planar, erp, exponent):
+	dx = chunk[:, 0, None] - planar[:, 0]
+	dy = chunk[:, 1, None] - planar[:, 1]
+	return predict(dx * dx + dy * dy, erp, exponent)
+
+
+def _logLikelihood(cells, planar, sigStrength, erp, exponent, sigma, center, priorKm, memoryBytes, lookup=None):
+	count = len(cells)
+	result = numpy.empty(count)
+	gains = numpy.empty(count)
+	step = max(1, memoryBytes // (8 * _TEMPORARIES * max(1, len(planar))))
+	for start in range(0, count, step):
+		chunk = cells[start:start + step]
+		if lookup is None:
+			predicted = _predict(chunk, planar, erp, exponent)
+		else:
+			# Stations without raster coverage at a cell fall back to the model
+			predicted = lookup(chunk)
+			(missingCells, missingStations) = numpy.nonzero(numpy.isnan(predicted))
+			if len(missingCells):
+				dx = chunk[missingCells, 0] - planar[missingStations, 0]
+				dy = chunk[missingCells, 1] - planar[missingStations, 1]
+				predicted[missingCells, missingStations] = predict(dx * dx + dy * dy, erp[missingStations],
+																   exponent[missingStations])
+		# The per-scan gain is profiled out: its best value is the mean residual
+		residual = sigStrength - predicted
+		gain = residual.mean(axis=1)
+		residual -= gain[:, None]
+		prior = ((chunk - center) ** 2).sum(axis=1) / (2 * priorKm ** 2)
+		result[start:start + step] = -(residual ** 2).sum(axis=1) / (2 * sigma ** 2) - prior
+		gains[start:start + step] = gain
+	return (result, gains)
+
+
+def _grid(center, halfWidth, cells):
+	offsets = (numpy.arange(cells) + 0.5) / cells * 2 - 1
+	(east, north) = numpy.meshgrid(center[0] + offsets * halfWidth, center[1] + offsets * halfWidth)
+	return numpy.column_stack((east.ravel(), north.ravel()))
+
+
+# Evaluates the observation likelihood on a cells x cells grid covering the
+# stations, then repeatedly zooms in on the best cell and its neighbours until
+# a cell is no wider than resolutionKm. With fieldraster.FieldRasters for
+# stations carrying a 'Row', predicted levels are looked up in the rasters.
+def locate(stations, resolutionKm=DEFAULT_RESOLUTION_KM, cells=DEFAULT_CELLS, marginKm=DEFAULT_MARGIN_KM,
+		   sigma=DEFAULT_SIGMA_DB, priorKm=DEFAULT_PRIOR_KM, memoryBytes=DEFAULT_MEMORY_BYTES,
+		   erp=None, exponent=None, projection=None, rasters=None):
+	(projection, sigStrength) = getScanProjection(stations, projection)
+	(erp, exponent) = stationParameters(stations, erp, exponent)
+	planar = getPlanarCoordinates(stations, projection)
+	prior = getInitialGuess(planar, sigStrength)
+	lookup = None
+	rows = [station.get('Row') for station in stations]
+	if rasters is not None and None not in rows:
+		lookup = lambda chunk: rasters.lookup(rows, *projection.inverse(chunk[:, 0], chunk[:, 1]))
+
+	low = planar.min(axis=0) - marginKm
+	high = planar.max(axis=0) + marginKm
+	center = (low + high) / 2
+	halfWidth = (high - low).max() / 2
+	cells = max(cells, 3)
+	covariance = None
+
+	while True:
+		grid = _grid(center, halfWidth, cells)
+		(logLikelihood, gains) = _logLikelihood(grid, planar, sigStrength, erp, exponent, sigma, prior, priorKm,
+												memoryBytes, lookup)
+		best = numpy.argmax(logLikelihood)
+		cellKm = 2 * halfWidth / cells
+		if covariance is None:
+			# The spread of the posterior is read off the coarse grid, which
+			# is the only level that sees all of it
+			weights = numpy.exp(logLikelihood - logLikelihood[best])
+			weights /= weights.sum()
+			deviation = grid - weights.dot(grid)
+			covariance = (weights[:, None] * deviation).T.dot(deviation) + numpy.eye(2) * cellKm ** 2 / 12
+		if cellKm <= resolutionKm:
+			break
+		center = grid[best]
+		halfWidth = 1.5 * cellKm
+
+	(lat, lng) = projection.inverse(grid[best, 0], grid[best, 1])
+	return {'Coordinates': [float(lat), float(lng)],
+			'Covariance': covariance,
+			'Gain': float(gains[best]),
+			'LogLikelihood': float(logLikelihood[best]),
+			'CellKm': cellKm}
@@ -0,0 +1,308 @@
+import numpy
+from scipy.spatial import cKDTree
+
+from geodesy import EARTH_RADIUS_KM, toCartesian
+from parser import callToPi, normalizePi
+from stations import toChannel
+
+# FM broadcast band, 87.5-108.0 MHz in 100 kHz channels
+MIN_CHANNEL = 875
+MAX_CHANNEL = 1080
+
+# Indexes absorb deltas into a brute-force side list and rebuild once it
+# grows past this many rows or this fraction of the indexed rows
+REBUILD_MIN = 1024
+REBUILD_FRACTION = 0.05
+
+
+def _chordToArc(chord):
+	return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.minimum(chord / (2 * EARTH_RADIUS_KM), 1.0))
+
+
+def _arcToChord(arc):
+	return 2 * EARTH_RADIUS_KM * numpy.sin(numpy.minimum(arc, numpy.pi * EARTH_RADIUS_KM) / (2 * EARTH_RADIUS_KM))
+
+
+def _grow(array, length, fill):
+	if len(array) >= length:
+		return array
+	grown = numpy.full(length, fill, dtype=array.dtype)
+	grown[:len(array)] = array
+	return grown
+
+
+class _DeltaIndex(object):
+
+	def __init__(self, store):
+		self.store = store
+		self._build()
+
+	def _build(self):
+		self.stale = numpy.zeros(len(self.store), dtype=bool)
+		self.extra = numpy.empty(0, dtype=numpy.intp)
+
+	def _pending(self):
+		return len(self.extra) + int(self.stale.sum())
+
+	def update(self, changed, deleted):
+		changed = numpy.asarray(changed, dtype=numpy.intp)
+		deleted = numpy.asarray(deleted, dtype=numpy.intp)
+		self.stale = _grow(self.stale, len(self.store), False)
+		self.stale[changed] = True
+		self.stale[deleted] = True
+		self.extra = numpy.setdiff1d(numpy.union1d(self.extra, changed), deleted)
+		if self._pending() > max(REBUILD_MIN, REBUILD_FRACTION * len(self.store)):
+			self._build()
+
+
+class SpatialIndex(_DeltaIndex):
+
+	def _build(self):
+		self.rows = numpy.flatnonzero(self.store.alive)
+		self.tree = cKDTree(toCartesian(self.store.latitude[self.rows], self.store.longitude[self.rows]))
+		_DeltaIndex._build(self)
+
+	def _extraDistances(self, point):
+		points = toCartesian(self.store.latitude[self.extra], self.store.longitude[self.extra])
+		return _chordToArc(numpy.sqrt(((points - point) ** 2).sum(axis=-1)))
+
+	def within(self, lat, lon, radiusKm):
+		point = toCartesian(lat, lon)
+		rows = self.rows[numpy.array(self.tree.query_ball_point(point, _arcToChord(radiusKm)), dtype=numpy.intp)]
+		if len(self.extra) or self.stale.any():
+			rows = rows[~self.stale[rows]]
+			rows = numpy.concatenate((rows, self.extra[self._extraDistances(point) <= radiusKm]))
+		rows.sort()
+		return rows
+
+	def nearest(self, lat, lon, k=1):
+		point = toCartesian(lat, lon)
+		if not len(self.extra) and not self.stale.any():
+			(chord, rows) = self.tree.query(point, k=min(k, self.tree.n))
+			return (self.rows[numpy.atleast_1d(rows)], _chordToArc(numpy.atleast_1d(chord)))
+
+		(chord, rows) = self.tree.query(point, k=min(k + int(self.stale.sum()), self.tree.n))
+		rows = self.rows[numpy.atleast_1d(rows)]
+		distances = _chordToArc(numpy.atleast_1d(chord))
+		fresh = ~self.stale[rows]
+		rows = numpy.concatenate((rows[fresh], self.extra))
+		distances = numpy.concatenate((distances[fresh], self._extraDistances(point)))
+		order = numpy.argsort(distances, kind='stable')[:k]
+		return (rows[order], distances[order])
+
+
+class _BucketIndex(_DeltaIndex):
+
+	buckets = 0
+
+	def _keys(self, rows):
+		raise NotImplementedError
+
+	def _build(self):
+		self.key = self._keys(numpy.arange(len(self.store)))
+		self.key[~self.store.alive] = -1
+		rows = numpy.flatnonzero(self.key >= 0)
+		self.order = rows[numpy.argsort(self.key[rows], kind='stable')]
+		self.offsets = numpy.searchsorted(self.key[self.order], numpy.arange(self.buckets + 1))
+		_DeltaIndex._build(self)
+
+	def update(self, changed, deleted):
+		self.key = _grow(self.key, len(self.store), -1)
+		self.key[changed] = self._keys(numpy.asarray(changed, dtype=numpy.intp))
+		self.key[deleted] = -1
+		_DeltaIndex.update(self, changed, deleted)
+
+	def bucket(self, key):
+		rows = self.order[self.offsets[key]:self.offsets[key + 1]]
+		if len(self.extra) or self.stale.any():
+			rows = rows[~self.stale[rows]]
+			rows = numpy.concatenate((rows, self.extra[self.key[self.extra] == key]))
+		return rows
+
+
+class ProjectedIndex(object):
+
+	def __init__(self, store, projection):
+		self.store = store
+		self.projection = projection
+		(self.east, self.north) = projection.forward(store.latitude, store.longitude)
+
+	def update(self, changed, deleted):
+		self.east = _grow(self.east, len(self.store), numpy.nan)
+		self.north = _grow(self.north, len(self.store), numpy.nan)
+		(self.east[changed], self.north[changed]) = self.projection.forward(self.store.latitude[changed],
+																			 self.store.longitude[changed])
+
+	def coordinates(self, rows):
+		return numpy.column_stack((self.east[rows], self.north[rows]))
+
+
+# Services sharing identical coordinates are one physical transmitter site.
+# Site ids stay stable across deltas; a site whose services are all deleted
+# is simply left empty.
+class SiteIndex(object):
+
+	def __init__(self, store):
+		self.store = store
+		rows = numpy.flatnonzero(store.alive)
+		coordinates = numpy.column_stack((store.latitude[rows], store.longitude[rows]))
+		(unique, inverse) = numpy.unique(coordinates, axis=0, return_inverse=True)
+		self.latitude = unique[:, 0].copy()
+		self.longitude = unique[:, 1].copy()
+		self.site = numpy.full(len(store), -1, dtype=numpy.int32)
+		self.site[rows] = inverse.ravel()
+		self._keys = None
+		self._sort()
+
+	def __len__(self):
+		return len(self.latitude)
+
+	def _sort(self):
+		rows = numpy.flatnonzero(self.site >= 0)
+		self.order = rows[numpy.argsort(self.site[rows], kind='stable')]
+		self.offsets = numpy.searchsorted(self.site[self.order], numpy.arange(len(self) + 1))
+
+	def update(self, changed, deleted):
+		if self._keys is None:
+			self._keys = dict(zip(zip(self.latitude.tolist(), self.longitude.tolist()), range(len(self))))
+		self.site = _grow(self.site, len(self.store), -1)
+		self.site[deleted] = -1
+		added = []
+		for row in changed:
+			key = (float(self.store.latitude[row]), float(self.store.longitude[row]))
+			site = self._keys.get(key)
+			if site is None:
+				site = self._keys[key] = len(self) + len(added)
+				added.append(key)
+			self.site[row] = site
+		if added:
+			(latitude, longitude) = zip(*added)
+			self.latitude = numpy.concatenate((self.latitude, latitude))
+			self.longitude = numpy.concatenate((self.longitude, longitude))
+		self._sort()
+
+	def rows(self, site):
+		return self.order[self.offsets[site]:self.offsets[site + 1]]
+
+	def counts(self):
+		return numpy.diff(self.offsets)
+
+
+# bounds are (south, west, north, east) in degrees; west > east wraps the antimeridian
+def inBounds(store, rows, bounds):
+	(south, west, north, east) = bounds
+	lat = store.latitude[rows]
+	lon = store.longitude[rows]
+	mask = (lat >= south) & (lat <= north)
+	if west <= east:
+		mask &= (lon >= west) & (lon <= east)
+	else:
+		mask &= (lon >= west) | (lon <= east)
+	return mask
+
+
+class FrequencyIndex(_BucketIndex):
+
+	buckets = MAX_CHANNEL - MIN_CHANNEL + 1
+
+	def _keys(self, rows):
+		channels = self.store.frequency[rows]
+		valid = (channels >= MIN_CHANNEL) & (channels <= MAX_CHANNEL)
+		return numpy.where(valid, channels - MIN_CHANNEL, -1).astype(numpy.int32)
+
+	def channel(self, mhz):
+		channel = int(toChannel(mhz))
+		if channel < MIN_CHANNEL or channel > MAX_CHANNEL:
+			return numpy.empty(0, dtype=numpy.intp)
+		return self.bucket(channel - MIN_CHANNEL)
+
+	def candidates(self, mhz, bounds=None):
+		channels = numpy.atleast_1d(toChannel(mhz)) - MIN_CHANNEL
+		valid = (channels >= 0) & (channels < self.buckets)
+		slots = numpy.where(valid, channels, 0)
+		starts = self.offsets[slots]
+		counts = numpy.where(valid, self.offsets[slots + 1] - starts, 0)
+
+		observed = numpy.repeat(numpy.arange(len(channels)), counts)
+		firsts = numpy.cumsum(counts) - counts
+		positions = numpy.arange(counts.sum()) - numpy.repeat(firsts - starts, counts)
+		rows = self.order[positions]
+
+		if len(self.extra) or self.stale.any():
+			fresh = ~self.stale[rows]
+			(extra, matched) = numpy.nonzero(self.key[self.extra][:, None] == numpy.where(valid, channels, -2)[None, :])
+			rows = numpy.concatenate((rows[fresh], self.extra[extra]))
+			observed = numpy.concatenate((observed[fresh], matched))
+
+		if bounds is not None:
+			mask = inBounds(self.store, rows, bounds)
+			rows = rows[mask]
+			observed = observed[mask]
+		return (rows, observed)
+
+
+class PiIndex(_BucketIndex):
+
+	buckets = 0x10000
+
+	def __init__(self, store):
+		self._pi = {}
+		_BucketIndex.__init__(self, store)
+
+	def _keys(self, rows):
+		codes = self.store.callsign[rows]
+		unique = numpy.unique(codes)
+		for code in unique:
+			if code not in self._pi:
+				self._pi[code] = callToPi(self.store.strings[code])
+		lookup = numpy.array([self._pi[code] for code in unique], dtype=numpy.int32)
+		return lookup[numpy.searchsorted(unique, codes)]
+
+	@property
+	def pi(self):
+		return self.key
+
+	def rows(self, pi):
+		if isinstance(pi, str):
+			pi = int(pi, 16)
+		return self.bucket(int(normalizePi(pi)))
+
+	def locate(self, pi):
+		rows = self.rows(pi)
+		return (self.store.latitude[rows], self.store.longitude[rows])
+
+
+def getSpatialIndex(store):
+	index = store.indexes.get('spatial')
+	if index is None:
+		index = store.indexes['spatial'] = SpatialIndex(store)
+	return index
+
+
+def getFrequencyIndex(store):
+	index = store.indexes.get('frequency')
+	if index is None:
+		index = store.indexes['frequency'] = FrequencyIndex(store)
+	return index
+
+
+def getPiIndex(store):
+	index = store.indexes.get('pi')
+	if index is None:
+		index = store.indexes['pi'] = PiIndex(store)
+	return index
+
+
+def getProjectedIndex(store, projection):
+	key = ('projected',) + projection.origin
+	index = store.indexes.get(key)
+	if index is None:
+		index = store.indexes[key] = ProjectedIndex(store, projection)
+	return index
+
+
+def getSiteIndex(store):
+	index = store.indexes.get('sites')
+	if index is None:
+		index = store.indexes['sites'] = SiteIndex(store)
+	return index
@@ -0,0 +1,87 @@
+import numpy
+
+from geodesy import zoneProjection
+from pathloss import jacobian, predict, stationParameters
+from triangulation import getPlanarCoordinates
+
+
+def getInitialGuess(planar, sigStrength):
+	weights = 10 ** ((sigStrength - sigStrength.max()) / 20)
+	return (weights[:, None] * planar).sum(axis=0) / weights.sum()
+
+
+# Signal strengths of a scan and, unless given, a zone projection centred on
+# their signal-weighted centroid
+def getScanProjection(stations, projection=None):
+	sigStrength = numpy.array([station['SignalStrength'] for station in stations], dtype=numpy.float64)
+	if projection is None:
+		coordinates = numpy.array([station['Coordinates'] for station in stations], dtype=numpy.float64)
+		projection = zoneProjection(*getInitialGuess(coordinates, sigStrength))
+	return (projection, sigStrength)
+
+
+def _evaluate(params, planar, sigStrength, erp, exponent):
+	dx = params[0] - planar[:, 0]
+	dy = params[1] - planar[:, 1]
+	return (sigStrength - predict(dx * dx + dy * dy, erp, exponent, params[2]), jacobian(dx, dy, exponent))
+
+
+# Levenberg-Marquardt fit of receiver east/north (km) and a per-scan gain
+# offset to the observed signal strengths under the log-distance model
+def solve(planar, sigStrength, erp, exponent, initial=None, maxIterations=50, tolerance=1e-6):
+	if initial is None:
+		initial = getInitialGuess(planar, sigStrength)
+	params = numpy.array([initial[0], initial[1], 0.0])
+	(residual, jacobian) = _evaluate(params, planar, sigStrength, erp, exponent)
+	params[2] = residual.mean()
+	(residual, jacobian) = _evaluate(params, planar, sigStrength, erp, exponent)
+	cost = residual.dot(residual)
+
+	damping = 1e-3
+	converged = False
+	for iteration in range(1, maxIterations + 1):
+		normal = jacobian.T.dot(jacobian)
+		gradient = jacobian.T.dot(residual)
+		try:
+			step = numpy.linalg.solve(normal + damping * numpy.diag(numpy.diag(normal) + 1e-12), gradient)
+		except numpy.linalg.LinAlgError:
+			break
+		candidate = params + step
+		(candidateResidual, candidateJacobian) = _evaluate(candidate, planar, sigStrength, erp, exponent)
+		candidateCost = candidateResidual.dot(candidateResidual)
+		if candidateCost < cost:
+			improvement = cost - candidateCost
+			(params, residual, jacobian, cost) = (candidate, candidateResidual, candidateJacobian, candidateCost)
+			damping = max(damping / 10, 1e-9)
+			if improvement <= tolerance * (cost + tolerance) or numpy.abs(step[:2]).max() < tolerance:
+				converged = True
+				break
+		else:
+			damping *= 10
+			if damping > 1e9:
+				converged = True
+				break
+
+	dof = len(residual) - len(params)
+	variance = cost / dof if dof > 0 else numpy.inf
+	try:
+		covariance = numpy.linalg.inv(jacobian.T.dot(jacobian)) * variance
+	except numpy.linalg.LinAlgError:
+		covariance = numpy.full((3, 3), numpy.inf)
+	return (params, covariance, residual, iteration, converged)
+
+
+def locate(stations, erp=None, exponent=None, projection=None, maxIterations=50, tolerance=1e-6):
+	(projection, sigStrength) = getScanProjection(stations, projection)
+	(erp, exponent) = stationParameters(stations, erp, exponent)
+	planar = getPlanarCoordinates(stations, projection)
+
+	(params, covariance, residual, iterations, converged) = solve(planar, sigStrength, erp, exponent,
+																   maxIterations=maxIterations, tolerance=tolerance)
+	(lat, lng) = projection.inverse(params[0], params[1])
+	return {'Coordinates': [float(lat), float(lng)],
+			'Covariance': covariance[:2, :2],
+			'Gain': float(params[2]),
+			'Residual': float(numpy.sqrt(numpy.mean(residual ** 2))),
+			'Iterations': iterations,
+			'Converged': converged}
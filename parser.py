@@ -1,42 +1,113 @@
+import os
 from string import ascii_uppercase
 
+import numpy
+
+from stations import getStations
+
+# NRSC-4 three-letter callsigns have fixed PI codes in 0x9950-0x99B9
+THREE_LETTER_CALLS = {
+    'KBW': 0x99A5, 'KCY': 0x99A6, 'KDB': 0x9990, 'KDF': 0x99A7, 'KEX': 0x9950,
+    'KFH': 0x9951, 'KFI': 0x9952, 'KGA': 0x9953, 'KGB': 0x9991, 'KGO': 0x9954,
+    'KGU': 0x9955, 'KGW': 0x9956, 'KGY': 0x9957, 'KHQ': 0x99AA, 'KID': 0x9958,
+    'KIT': 0x9959, 'KJR': 0x995A, 'KLO': 0x995B, 'KLZ': 0x995C, 'KMA': 0x995D,
+    'KMJ': 0x995E, 'KNX': 0x995F, 'KOA': 0x9960, 'KOB': 0x99AB, 'KOY': 0x9992,
+    'KPQ': 0x9993, 'KQV': 0x9964, 'KSD': 0x9994, 'KSL': 0x9965, 'KUJ': 0x9966,
+    'KUT': 0x9995, 'KVI': 0x9967, 'KWG': 0x9968, 'KXL': 0x9996, 'KXO': 0x9997,
+    'KYW': 0x996B, 'WBT': 0x9999, 'WBZ': 0x996D, 'WDZ': 0x996E, 'WEW': 0x996F,
+    'WGH': 0x999A, 'WGL': 0x9971, 'WGN': 0x9972, 'WGR': 0x9973, 'WGY': 0x999B,
+    'WHA': 0x9975, 'WHB': 0x9976, 'WHK': 0x9977, 'WHO': 0x999C, 'WHP': 0x9978,
+    'WIL': 0x999D, 'WIP': 0x997A, 'WIS': 0x99B3, 'WJR': 0x997B, 'WJW': 0x99B4,
+    'WJZ': 0x99B5, 'WKY': 0x997C, 'WLS': 0x997D, 'WLW': 0x997E, 'WMC': 0x999E,
+    'WMT': 0x999F, 'WOC': 0x9981, 'WOI': 0x99A0, 'WOL': 0x9983, 'WOR': 0x9984,
+    'WOW': 0x99A1, 'WRC': 0x99B9, 'WRR': 0x99A2, 'WSB': 0x99A3, 'WSM': 0x99A4,
+    'WWJ': 0x9988, 'WWL': 0x9989,
+}
+
+K_BASE = 0x1000
+W_BASE = 0x54A8
+THREE_LETTER_BASE = 0x9950
+
+PI_TABLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pi_callsigns.npy')
+
+_piTable = None
+
+
+def int_to_b26(n, width=3):
+    letters = ""
+    for _ in range(width):
+        (n, r) = divmod(n, 26)
+        letters = ascii_uppercase[r] + letters
+    return letters
+
+
+# Transmitted PI codes -> the codes their callsigns encode to
+def normalizePi(pi):
+    pi = numpy.asarray(pi, dtype=numpy.int64)
+    # AFxx is transmitted for xx00, and A?xx for ?0xx
+    code = numpy.where((pi & 0xFF00) == 0xAF00, (pi & 0xFF) << 8, pi)
+    linked = ((pi & 0xF000) == 0xA000) & ((pi & 0xFF00) != 0xAF00) & ((pi & 0x0F00) != 0)
+    return numpy.where(linked, ((pi & 0x0F00) << 4) | (pi & 0xFF), code)
+
+
+def _buildPiTable():
+    code = normalizePi(numpy.arange(0x10000))
+
+    letters = numpy.array(list(ascii_uppercase))
+    table = numpy.full(0x10000, '', dtype='U4')
+    for (prefix, base) in (('K', K_BASE), ('W', W_BASE)):
+        offset = code - base
+        valid = (offset >= 0) & (offset < 26 ** 3) & (code < THREE_LETTER_BASE)
+        offset = offset[valid]
+        table[valid] = numpy.char.add(numpy.char.add(numpy.char.add(prefix, letters[offset // 676]),
+                                                     letters[offset // 26 % 26]), letters[offset % 26])
+    for (callsign, value) in THREE_LETTER_CALLS.items():
+        table[code == value] = callsign
+    # Bxxx, Dxxx and Exxx belong to linked networks and stay empty
+    return table
+
+
+def getPiTable():
+    global _piTable
+    if _piTable is None:
+        try:
+            _piTable = numpy.load(PI_TABLE_FILE, mmap_mode='r')
+        except (OSError, ValueError):
+            _piTable = _buildPiTable()
+            try:
+                numpy.save(PI_TABLE_FILE, _piTable)
+            except OSError:
+                pass
+    return _piTable
+
+
+def pi_to_call(codes):
+    codes = numpy.asarray(codes)
+    if codes.dtype.kind in 'US':
+        codes = numpy.vectorize(lambda code: int(code, 16), otypes=[numpy.int64])(codes)
+    return getPiTable()[codes.astype(numpy.int64) & 0xFFFF]
+
+
 def piToCall(piCode):
-    piDeci = int(piCode,16)
-    callsign = ""
-    digits = str(piDeci)
-    if piDeci >= 21672:
-        callsign+="W"
-        inductor = piDeci - 21762
-        print(int_to_b26(inductor))
-        callsign+=int_to_b26(inductor)
-
-    else:
-        callsign+="K"
-        inductor = piDeci - 4096
-        callsign+=base10toN(int(piCode[1]),26)
-        callsign+=base10toN(int(piCode[2]),26)
-        callsign+=base10toN(int(piCode[3]),26)
-    return callsign
-
-def int_to_b26(n):
-    if n < 25:
-        return ascii_uppercase[n]
-    else:
-        q, r = divmod(n, 25)
-        return int_to_b26(q) + ascii_uppercase[r]
-    
+    return str(pi_to_call(int(piCode, 16)))
 
-def data_parser():
 
-    info={'Longitude': [], 'Latitude': [], 'Callsign':[]}
-    with open('fm_stations.csv') as fobj:
-        next(fobj)
-        for line in fobj:
-            rawdata = line.split(',')
-            info['Longitude'].append(rawdata[0])
-            info['Latitude'].append(rawdata[1])
-            info['Callsign'].append(rawdata[2].split('-',1)[0])
-    return info
+def callToPi(callsign):
+    callsign = callsign.upper()
+    if callsign in THREE_LETTER_CALLS:
+        return THREE_LETTER_CALLS[callsign]
+    if len(callsign) != 4 or not callsign.isalpha() or callsign[0] not in 'KW':
+        return -1
+    base = 4096 if callsign[0] == 'K' else 21672
+    (a, b, c) = [ascii_uppercase.index(letter) for letter in callsign[1:]]
+    return base + 676 * a + 26 * b + c
+
+
+def data_parser():
+    store = getStations()
+    return {'Longitude': store.longitude.tolist(),
+            'Latitude': store.latitude.tolist(),
+            'Callsign': store.decode(store.callsign).tolist()}
 
    
 if __name__=="__main__":
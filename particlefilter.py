@@ -0,0 +1,101 @@
+import numpy
+
+from multilateration import getScanProjection
+from pathloss import DEFAULT_SIGMA_DB, predict, stationParameters
+from triangulation import getPlanarCoordinates
+
+DEFAULT_PARTICLES = 10000
+DEFAULT_MARGIN_KM = 50.0
+DEFAULT_PROCESS_NOISE_KM = 0.05
+# Resample once the effective sample size drops below this fraction
+RESAMPLE_THRESHOLD = 0.5
+DEFAULT_CHUNK = 1 << 20
+
+
+def systematicResample(weights, random):
+	count = len(weights)
+	positions = (random.random_sample() + numpy.arange(count)) / count
+	cumulative = numpy.cumsum(weights)
+	cumulative[-1] = 1.0
+	return numpy.searchsorted(cumulative, positions)
+
+
+# Particles are east/north positions in km on a local tangent plane. The
+# receiver gain is profiled out per particle, so a weight update for all
+# particles against all heard stations is one broadcast over (particles,
+# stations), evaluated chunkSize pairs at a time to bound memory.
+class ParticleFilter(object):
+
+	def __init__(self, projection, count=DEFAULT_PARTICLES, sigma=DEFAULT_SIGMA_DB,
+				 processNoiseKm=DEFAULT_PROCESS_NOISE_KM, chunkSize=DEFAULT_CHUNK, seed=None):
+		self.projection = projection
+		self.count = count
+		self.sigma = sigma
+		self.processNoiseKm = processNoiseKm
+		self.chunkSize = chunkSize
+		self.random = numpy.random.RandomState(seed)
+		self.particles = numpy.zeros((count, 2))
+		self.logWeights = numpy.full(count, -numpy.log(count))
+
+	def spread(self, low, high):
+		self.particles = self.random.uniform(low, high, (self.count, 2))
+		self.logWeights[:] = -numpy.log(self.count)
+
+	def predict(self, dt=1.0):
+		self.particles += self.random.normal(0, self.processNoiseKm * numpy.sqrt(dt), self.particles.shape)
+
+	def logLikelihood(self, planar, sigStrength, erp, exponent):
+		result = numpy.empty(self.count)
+		step = max(1, self.chunkSize // max(1, len(planar)))
+		for start in range(0, self.count, step):
+			chunk = self.particles[start:start + step]
+			dx = chunk[:, 0, None] - planar[:, 0]
+			dy = chunk[:, 1, None] - planar[:, 1]
+			residual = sigStrength - predict(dx * dx + dy * dy, erp, exponent)
+			residual -= residual.mean(axis=1)[:, None]
+			result[start:start + step] = -numpy.einsum('ij,ij->i', residual, residual) / (2 * self.sigma ** 2)
+		return result
+
+	def update(self, planar, sigStrength, erp, exponent, scale=1.0):
+		self.logWeights += scale * self.logLikelihood(planar, sigStrength, erp, exponent)
+		self.logWeights -= self.logWeights.max()
+		weights = numpy.exp(self.logWeights)
+		weights /= weights.sum()
+		self.logWeights = numpy.log(weights)
+		if 1.0 / numpy.square(weights).sum() < RESAMPLE_THRESHOLD * self.count:
+			self.particles = self.particles[systematicResample(weights, self.random)]
+			self.logWeights[:] = -numpy.log(self.count)
+
+	def updateStations(self, stations, erp=None, exponent=None, scale=1.0):
+		sigStrength = numpy.array([station['SignalStrength'] for station in stations], dtype=numpy.float64)
+		(erp, exponent) = stationParameters(stations, erp, exponent)
+		self.update(getPlanarCoordinates(stations, self.projection), sigStrength, erp, exponent, scale)
+
+	def estimate(self):
+		weights = numpy.exp(self.logWeights)
+		weights /= weights.sum()
+		mean = weights.dot(self.particles)
+		deviation = self.particles - mean
+		covariance = (weights[:, None] * deviation).T.dot(deviation)
+		best = self.particles[numpy.argmax(weights)]
+		(lat, lng) = self.projection.inverse(mean[0], mean[1])
+		(bestLat, bestLng) = self.projection.inverse(best[0], best[1])
+		return {'Coordinates': [float(lat), float(lng)],
+				'Covariance': covariance,
+				'Mode': [float(bestLat), float(bestLng)],
+				'EffectiveParticles': float(1.0 / numpy.square(weights).sum())}
+
+
+# One-shot fix: the likelihood is applied in tempered steps, with jitter in
+# between, so the particles can move into the peak instead of collapsing
+# onto the few that started nearest to it
+def locate(stations, count=DEFAULT_PARTICLES, marginKm=DEFAULT_MARGIN_KM, iterations=3, seed=None, **options):
+	projection = getScanProjection(stations)[0]
+	particles = ParticleFilter(projection, count, seed=seed, **options)
+	planar = getPlanarCoordinates(stations, projection)
+	particles.spread(planar.min(axis=0) - marginKm, planar.max(axis=0) + marginKm)
+	for iteration in range(iterations):
+		if iteration:
+			particles.predict()
+		particles.updateStations(stations, scale=1.0 / iterations)
+	return particles.estimate()
@@ -0,0 +1,43 @@
+import numpy
+
+# Log-distance path loss model shared by the locator engines:
+#   rssi = erp + gain - 10 * exponent * log10(d / REFERENCE_KM)
+# erp is the station's level at REFERENCE_KM and gain the receiver's
+# unknown offset for a scan. Distances are softened by MIN_DISTANCE_KM so
+# the model stays finite on top of a transmitter.
+REFERENCE_KM = 1.0
+MIN_DISTANCE_KM = 0.1
+DEFAULT_EXPONENT = 2.7
+DEFAULT_ERP = 0.0
+# Spread of a reading around the model: shadowing plus receiver noise
+DEFAULT_SIGMA_DB = 6.0
+
+LOG10 = numpy.log(10)
+
+
+def effectiveDistanceSquared(distanceSquared):
+	return distanceSquared + MIN_DISTANCE_KM ** 2
+
+
+# Level at a receiver distanceSquared km^2 from the station. The locators
+# have squared planar distances at hand, which saves a square root.
+def predict(distanceSquared, erp=DEFAULT_ERP, exponent=DEFAULT_EXPONENT, gain=0.0):
+	return erp + gain - 5 * exponent * numpy.log10(effectiveDistanceSquared(distanceSquared) / REFERENCE_KM ** 2)
+
+
+# d predict / d(east, north, gain) for a receiver at planar offset (dx, dy) km
+# from the station, stacked on a new last axis
+def jacobian(dx, dy, exponent=DEFAULT_EXPONENT):
+	slope = -10 * exponent / LOG10 / effectiveDistanceSquared(dx * dx + dy * dy)
+	(east, north) = numpy.broadcast_arrays(slope * dx, slope * dy)
+	return numpy.stack((east, north, numpy.ones_like(east)), axis=-1)
+
+
+def stationParameters(stations, erp=None, exponent=None):
+	count = len(stations)
+	if erp is None:
+		erp = [station.get('Erp', DEFAULT_ERP) for station in stations]
+	if exponent is None:
+		exponent = [station.get('Exponent', DEFAULT_EXPONENT) for station in stations]
+	return (numpy.broadcast_to(numpy.asarray(erp, dtype=numpy.float64), (count,)),
+			numpy.broadcast_to(numpy.asarray(exponent, dtype=numpy.float64), (count,)))
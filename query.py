@@ -0,0 +1,75 @@
+import re
+
+import numpy
+
+from indexes import getSpatialIndex, inBounds
+from stations import getStations, toChannel
+
+# FM translators carry a channel-number callsign such as K246AX or W264BF
+TRANSLATOR = re.compile(r'^[KW]\d{3}[A-Z]{2}$')
+
+
+class StationQuery(object):
+
+	def __init__(self, store=None):
+		self.store = store if store is not None else getStations()
+		self._masks = []
+		self._candidates = []
+
+	def _codeMask(self, column, lookup):
+		codes = getattr(self.store, column)
+		return lambda rows: lookup[codes[rows]]
+
+	def frequency(self, low, high=None):
+		low = int(toChannel(low))
+		high = low if high is None else int(toChannel(high))
+		frequency = self.store.frequency
+		self._masks.append(lambda rows: (frequency[rows] >= low) & (frequency[rows] <= high))
+		return self
+
+	def bounds(self, south, west, north, east):
+		self._masks.append(lambda rows: inBounds(self.store, rows, (south, west, north, east)))
+		return self
+
+	def radius(self, lat, lon, km):
+		self._candidates.append(lambda: getSpatialIndex(self.store).within(lat, lon, km))
+		return self
+
+	def callsign(self, prefix):
+		self._masks.append(self._codeMask('callsign', numpy.char.startswith(self.store.text(), prefix.upper())))
+		return self
+
+	def service(self, *services):
+		self._masks.append(self._codeMask('service', numpy.isin(self.store.text(), services)))
+		return self
+
+	def state(self, *states):
+		self._masks.append(self._codeMask('state', numpy.isin(self.store.text(), [state.upper() for state in states])))
+		return self
+
+	def translators(self, wanted=True):
+		lookup = numpy.array([bool(TRANSLATOR.match(text)) for text in self.store.text()], dtype=bool)
+		self._masks.append(self._codeMask('callsign', lookup if wanted else ~lookup))
+		return self
+
+	def rows(self):
+		if self._candidates:
+			rows = self._candidates[0]()
+			for candidate in self._candidates[1:]:
+				rows = numpy.intersect1d(rows, candidate(), assume_unique=True)
+			rows = rows[self.store.alive[rows]]
+		else:
+			rows = numpy.flatnonzero(self.store.alive)
+		for mask in self._masks:
+			if not len(rows):
+				break
+			rows = rows[mask(rows)]
+		return rows
+
+	def mask(self):
+		mask = numpy.zeros(len(self.store), dtype=bool)
+		mask[self.rows()] = True
+		return mask
+
+	def stations(self):
+		return [self.store.station(row) for row in self.rows()]
@@ -0,0 +1,108 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+import multilateration
+from multilateration import getScanProjection
+from pathloss import jacobian, predict, stationParameters
+from triangulation import getPlanarCoordinates
+
+MINIMAL_STATIONS = 3
+DEFAULT_HYPOTHESES = 512
+DEFAULT_BATCH = 128
+# Readings further than this from a hypothesis, in dB, are outliers to it
+THRESHOLD_DB = 12.0
+ITERATIONS = 10
+
+
+def _residuals(positions, planar, sigStrength, erp, exponent):
+	dx = positions[:, 0, None] - planar[..., 0]
+	dy = positions[:, 1, None] - planar[..., 1]
+	return (sigStrength - predict(dx * dx + dy * dy, erp, exponent), dx, dy)
+
+
+# Damped Gauss-Newton on every minimal subset at once: east, north and gain
+# from three readings, as (hypotheses, 3) parameters
+def _solveSubsets(planar, sigStrength, erp, exponent):
+	weights = 10 ** ((sigStrength - sigStrength.max(axis=1)[:, None]) / 20)
+	params = numpy.zeros((len(planar), 3))
+	params[:, :2] = (weights[:, :, None] * planar).sum(axis=1) / weights.sum(axis=1)[:, None]
+	(offset, dx, dy) = _residuals(params, planar, sigStrength, erp, exponent)
+	params[:, 2] = offset.mean(axis=1)
+	cost = ((offset - params[:, 2, None]) ** 2).sum(axis=1)
+	damping = numpy.full(len(planar), 1e-3)
+
+	for iteration in range(ITERATIONS):
+		(offset, dx, dy) = _residuals(params, planar, sigStrength, erp, exponent)
+		residual = offset - params[:, 2, None]
+		rows = jacobian(dx, dy, exponent)
+		normal = numpy.einsum('hsi,hsj->hij', rows, rows)
+		diagonal = numpy.einsum('hii->hi', normal)
+		normal[:, numpy.arange(3), numpy.arange(3)] += damping[:, None] * diagonal + 1e-9
+		step = numpy.linalg.solve(normal, numpy.einsum('hsi,hs->hi', rows, residual)[:, :, None])[:, :, 0]
+
+		candidate = params + step
+		(offset, dx, dy) = _residuals(candidate, planar, sigStrength, erp, exponent)
+		candidateCost = ((offset - candidate[:, 2, None]) ** 2).sum(axis=1)
+		better = candidateCost < cost
+		params[better] = candidate[better]
+		cost[better] = candidateCost[better]
+		damping = numpy.where(better, numpy.maximum(damping / 10, 1e-9), numpy.minimum(damping * 10, 1e9))
+	return params
+
+
+# Scores one batch of hypotheses against every reading. The gain is taken as
+# the median offset over all stations, so outliers cannot move it.
+def _scoreBatch(subsets, planar, sigStrength, erp, exponent, threshold):
+	positions = _solveSubsets(planar[subsets], sigStrength[subsets], erp[subsets], exponent[subsets])
+	offset = _residuals(positions, planar, sigStrength, erp, exponent)[0]
+	residual = numpy.abs(offset - numpy.median(offset, axis=1)[:, None])
+	inliers = residual <= threshold
+	# Truncated quadratic cost ranks hypotheses with the same inlier count
+	cost = numpy.minimum(residual, threshold) ** 2
+	return (inliers.sum(axis=1), cost.sum(axis=1), inliers)
+
+
+# Draws hypotheses minimal station subsets up front from seed, so the result
+# does not depend on how the batches are spread over workers. The stations
+# agreeing with the best hypothesis are refitted with solver.
+def locate(stations, hypotheses=DEFAULT_HYPOTHESES, threshold=THRESHOLD_DB, seed=None, workers=1,
+		   batchSize=DEFAULT_BATCH, executor=None, solver=None, **options):
+	if len(stations) <= MINIMAL_STATIONS:
+		fix = (solver or multilateration.locate)(stations, **options)
+		fix['Inliers'] = list(stations)
+		fix['Outliers'] = []
+		return fix
+
+	(projection, sigStrength) = getScanProjection(stations)
+	planar = getPlanarCoordinates(stations, projection)
+	(erp, exponent) = stationParameters(stations)
+	erp = numpy.ascontiguousarray(erp)
+	exponent = numpy.ascontiguousarray(exponent)
+
+	random = numpy.random.RandomState(seed)
+	subsets = numpy.argpartition(random.random_sample((hypotheses, len(stations))), MINIMAL_STATIONS,
+								 axis=1)[:, :MINIMAL_STATIONS]
+	batches = [subsets[start:start + batchSize] for start in range(0, hypotheses, batchSize)]
+	arguments = (planar, sigStrength, erp, exponent, threshold)
+
+	if executor is not None:
+		results = list(executor.map(_scoreBatch, batches, *[[argument] * len(batches) for argument in arguments]))
+	elif workers > 1 and len(batches) > 1:
+		with ProcessPoolExecutor(max_workers=min(workers, len(batches))) as pool:
+			results = list(pool.map(_scoreBatch, batches, *[[argument] * len(batches) for argument in arguments]))
+	else:
+		results = [_scoreBatch(batch, *arguments) for batch in batches]
+
+	counts = numpy.concatenate([result[0] for result in results])
+	costs = numpy.concatenate([result[1] for result in results])
+	best = numpy.lexsort((costs, -counts))[0]
+	inliers = results[best // batchSize][2][best % batchSize]
+
+	if inliers.sum() < MINIMAL_STATIONS:
+		inliers[:] = True
+	chosen = [station for (station, inlier) in zip(stations, inliers.tolist()) if inlier]
+	fix = (solver or multilateration.locate)(chosen, **options)
+	fix['Inliers'] = chosen
+	fix['Outliers'] = [station for (station, inlier) in zip(stations, inliers.tolist()) if not inlier]
+	return fix
@@ -0,0 +1,115 @@
+import numpy
+from scipy.spatial import QhullError
+
+import multilateration
+from geodesy import zoneProjection
+from multilateration import getScanProjection, getInitialGuess
+from pathloss import jacobian, stationParameters
+from triangulation import getPlanarCoordinates, getSiteIds, getVoronaiPoints
+
+DEFAULT_SITES = 8
+# det / product of the diagonal below this counts as singular geometry
+SINGULAR = 1e-10
+
+
+# Rows of the multilateration Jacobian, d rssi / d(east, north, gain), for
+# unit-variance readings taken at position
+def geometryRows(planar, position, exponent):
+	return jacobian(position[0] - planar[:, 0], position[1] - planar[:, 1], exponent)
+
+
+# sqrt(trace(inverse)) of a stack of 3x3 information matrices, from the
+# principal minors so that singular members come out as inf instead of
+# failing the whole batch
+def gdop(information):
+	a = numpy.asarray(information, dtype=numpy.float64)
+	minors = (a[..., 0, 0] * a[..., 1, 1] - a[..., 0, 1] * a[..., 1, 0] +
+			  a[..., 0, 0] * a[..., 2, 2] - a[..., 0, 2] * a[..., 2, 0] +
+			  a[..., 1, 1] * a[..., 2, 2] - a[..., 1, 2] * a[..., 2, 1])
+	determinant = (a[..., 0, 0] * (a[..., 1, 1] * a[..., 2, 2] - a[..., 1, 2] * a[..., 2, 1]) -
+				   a[..., 0, 1] * (a[..., 1, 0] * a[..., 2, 2] - a[..., 1, 2] * a[..., 2, 0]) +
+				   a[..., 0, 2] * (a[..., 1, 0] * a[..., 2, 1] - a[..., 1, 1] * a[..., 2, 0]))
+	scale = a[..., 0, 0] * a[..., 1, 1] * a[..., 2, 2]
+	valid = determinant > SINGULAR * scale
+	with numpy.errstate(divide='ignore', invalid='ignore'):
+		return numpy.where(valid, numpy.sqrt(minors / determinant), numpy.inf)
+
+
+# GDOP of every subset at once: rows is (stations, 3), subsets an (m, s)
+# array of row indices
+def subsetGdop(rows, subsets):
+	selected = rows[numpy.asarray(subsets, dtype=numpy.intp)]
+	return gdop(numpy.einsum('msi,msj->mij', selected, selected))
+
+
+def stationGdop(stations, lat, lon, projection=None):
+	projection = projection or zoneProjection(lat, lon)
+	(east, north) = projection.forward(lat, lon)
+	(erp, exponent) = stationParameters(stations)
+	rows = geometryRows(getPlanarCoordinates(stations, projection), (east, north), exponent)
+	return float(gdop(rows.T.dot(rows)))
+
+
+# Picks up to k transmitter sites: the Delaunay triangle of sites with the
+# best GDOP, then greedily whichever neighbouring site lowers it most.
+# Geometry is linearized at the signal-weighted centroid. Returns the
+# stations of the chosen sites and their GDOP.
+def selectStations(stations, k=DEFAULT_SITES, projection=None):
+	(projection, sigStrength) = getScanProjection(stations, projection)
+	planar = getPlanarCoordinates(stations, projection)
+	(erp, exponent) = stationParameters(stations)
+	rows = geometryRows(planar, getInitialGuess(planar, sigStrength), exponent)
+
+	(members, siteCount) = getSiteIds(stations)
+	information = numpy.zeros((siteCount, 3, 3))
+	numpy.add.at(information, members, rows[:, :, None] * rows[:, None, :])
+
+	simplices = numpy.empty((0, 3), dtype=numpy.intp)
+	if siteCount >= 3:
+		try:
+			simplices = getVoronaiPoints(stations, projection)[1]
+		except QhullError:
+			pass
+
+	chosen = numpy.zeros(siteCount, dtype=bool)
+	current = numpy.zeros((3, 3))
+	if siteCount <= k:
+		chosen[:] = True
+		current = information.sum(axis=0)
+	elif len(simplices):
+		best = simplices[numpy.argmin(gdop(information[simplices].sum(axis=1)))]
+		chosen[best] = True
+		current = information[best].sum(axis=0)
+
+	adjacent = numpy.zeros((siteCount, siteCount), dtype=bool)
+	for (a, b) in ((0, 1), (1, 2), (0, 2)):
+		adjacent[simplices[:, a], simplices[:, b]] = True
+		adjacent[simplices[:, b], simplices[:, a]] = True
+
+	while chosen.sum() < min(k, siteCount):
+		candidates = numpy.flatnonzero(adjacent[chosen].any(axis=0) & ~chosen)
+		if not len(candidates):
+			candidates = numpy.flatnonzero(~chosen)
+		scores = gdop(current + information[candidates])
+		if numpy.isinf(scores).all():
+			# No geometry yet: take the strongest remaining site
+			signal = numpy.full(siteCount, -numpy.inf)
+			numpy.maximum.at(signal, members, sigStrength)
+			pick = candidates[numpy.argmax(signal[candidates])]
+		else:
+			pick = candidates[numpy.argmin(scores)]
+		chosen[pick] = True
+		current = current + information[pick]
+
+	selected = [station for (station, site) in zip(stations, members.tolist()) if chosen[site]]
+	return (selected, float(gdop(current)))
+
+
+# Solves with the selected subset only and reports the GDOP of that subset
+# at the fix
+def locate(stations, k=DEFAULT_SITES, solver=None, **options):
+	selected = selectStations(stations, k)[0]
+	fix = (solver or multilateration.locate)(selected, **options)
+	fix['GDOP'] = stationGdop(selected, *fix['Coordinates'])
+	fix['Stations'] = selected
+	return fix
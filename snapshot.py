@@ -0,0 +1,198 @@
+import contextlib
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+
+import numpy
+
+from stations import StationStore, parseStations
+
+# Layout: header | fixed-width station records | string offsets | utf-8 string blob
+MAGIC = b'FMSNAP\x00\x01'
+HEADER = struct.Struct('<8sQQQQq20s4x')
+RECORD = numpy.dtype([('longitude', '<f8'), ('latitude', '<f8'), ('frequency', '<i4'),
+					  ('callsign', '<i4'), ('service', '<i4'), ('city', '<i4'),
+					  ('state', '<i4'), ('flags', '<i4')])
+DELETED = 1
+
+SUFFIX = '.snap'
+# Deltas applied since the snapshot was written, one JSON object per line
+LOG_SUFFIX = '.log'
+
+
+class SnapshotError(Exception):
+	pass
+
+
+def snapshotPath(csvPath):
+	return csvPath + SUFFIX
+
+
+def logPath(csvPath):
+	return snapshotPath(csvPath) + LOG_SUFFIX
+
+
+def _digest(path):
+	sha = hashlib.sha1()
+	with open(path, 'rb') as fobj:
+		for block in iter(lambda: fobj.read(1 << 20), b''):
+			sha.update(block)
+	return sha.digest()
+
+
+def _stamp(csvPath):
+	info = os.stat(csvPath)
+	return (info.st_size, info.st_mtime_ns)
+
+
+# Yields a file in target's directory that replaces target once the block
+# completes, so readers never see a partial file
+@contextlib.contextmanager
+def atomicWrite(target, suffix='.tmp'):
+	(fd, temporary) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), suffix=suffix)
+	try:
+		with os.fdopen(fd, 'wb') as fobj:
+			yield fobj
+		os.chmod(temporary, 0o644)
+		os.replace(temporary, target)
+	except BaseException:
+		if os.path.exists(temporary):
+			os.remove(temporary)
+		raise
+
+
+def writeSnapshot(store, snapPath, csvPath):
+	(size, mtime) = _stamp(csvPath)
+	digest = _digest(csvPath)
+
+	records = numpy.zeros(len(store), dtype=RECORD)
+	for name in ('longitude', 'latitude', 'frequency', 'callsign', 'service', 'city', 'state'):
+		records[name] = getattr(store, name)
+	records['flags'] = numpy.where(store.alive, 0, DELETED)
+
+	encoded = [text.encode('utf-8') for text in store.strings]
+	offsets = numpy.zeros(len(encoded) + 1, dtype='<u8')
+	numpy.cumsum([len(text) for text in encoded], out=offsets[1:])
+	blob = b''.join(encoded)
+
+	with atomicWrite(snapPath, SUFFIX) as fobj:
+		fobj.write(HEADER.pack(MAGIC, len(records), len(encoded), len(blob), size, mtime, digest))
+		fobj.write(records.tobytes())
+		fobj.write(offsets.tobytes())
+		fobj.write(blob)
+
+
+def readSnapshot(snapPath):
+	with open(snapPath, 'rb') as fobj:
+		buf = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+	if len(buf) < HEADER.size:
+		raise SnapshotError('truncated snapshot header')
+	(magic, rows, count, blobSize, size, mtime, digest) = HEADER.unpack_from(buf, 0)
+	if magic != MAGIC:
+		raise SnapshotError('bad snapshot magic %r' % magic)
+
+	offset = HEADER.size
+	end = offset + rows * RECORD.itemsize + (count + 1) * 8 + blobSize
+	if len(buf) != end:
+		raise SnapshotError('snapshot size %d, expected %d' % (len(buf), end))
+
+	records = numpy.frombuffer(buf, dtype=RECORD, count=rows, offset=offset)
+	offset += rows * RECORD.itemsize
+	offsets = numpy.frombuffer(buf, dtype='<u8', count=count + 1, offset=offset)
+	offset += (count + 1) * 8
+	blob = buf[offset:offset + blobSize]
+
+	strings = numpy.empty(count, dtype=object)
+	bounds = offsets.tolist()
+	strings[:] = [blob[bounds[i]:bounds[i + 1]].decode('utf-8') for i in range(count)]
+
+	store = StationStore(records['longitude'], records['latitude'], records['frequency'],
+						 records['callsign'], records['service'], records['city'],
+						 records['state'], strings, (records['flags'] & DELETED) == 0)
+	return (store, (size, mtime, digest))
+
+
+def _restamp(snapPath, size, mtime, digest):
+	with open(snapPath, 'r+b') as fobj:
+		header = bytearray(fobj.read(HEADER.size))
+		fields = list(HEADER.unpack(bytes(header)))
+		fields[4:7] = [size, mtime, digest]
+		fobj.seek(0)
+		fobj.write(HEADER.pack(*fields))
+
+
+def _jsonScalar(value):
+	if isinstance(value, numpy.generic):
+		return value.item()
+	raise TypeError('%r is not JSON serializable' % (value,))
+
+
+# One delta log line; encoded before the delta is applied, so a delta that
+# cannot be logged never reaches the store
+def encodeDelta(upserts=(), deletes=()):
+	entry = {'upserts': list(upserts), 'deletes': [list(key) for key in deletes]}
+	return json.dumps(entry, default=_jsonScalar) + '\n'
+
+
+def appendDelta(csvPath, line):
+	with open(logPath(csvPath), 'a') as fobj:
+		fobj.write(line)
+
+
+def _replay(store, csvPath):
+	try:
+		fobj = open(logPath(csvPath))
+	except OSError:
+		return store
+	with fobj:
+		for line in fobj:
+			try:
+				entry = json.loads(line)
+			except ValueError:
+				break
+			store.applyDelta(entry['upserts'], [tuple(key) for key in entry['deletes']])
+	return store
+
+
+def compactSnapshot(csvPath):
+	store = loadStations(csvPath)
+	writeSnapshot(store, snapshotPath(csvPath), csvPath)
+	if os.path.exists(logPath(csvPath)):
+		os.remove(logPath(csvPath))
+	return readSnapshot(snapshotPath(csvPath))[0]
+
+
+def loadStations(csvPath, verify=False):
+	snapPath = snapshotPath(csvPath)
+	(size, mtime) = _stamp(csvPath)
+
+	try:
+		(store, stamp) = readSnapshot(snapPath)
+	except (OSError, SnapshotError):
+		store = None
+
+	if store is not None:
+		if not verify and stamp[:2] == (size, mtime):
+			return _replay(store, csvPath)
+		digest = _digest(csvPath)
+		if stamp[2] == digest:
+			if stamp[:2] != (size, mtime):
+				try:
+					_restamp(snapPath, size, mtime, digest)
+				except OSError:
+					pass
+			return _replay(store, csvPath)
+
+	# The CSV itself changed, so deltas logged against the old snapshot are obsolete
+	store = parseStations(csvPath)
+	try:
+		writeSnapshot(store, snapPath, csvPath)
+		if os.path.exists(logPath(csvPath)):
+			os.remove(logPath(csvPath))
+	except OSError:
+		return store
+	return readSnapshot(snapPath)[0]
@@ -0,0 +1,279 @@
+import csv
+import os
+import re
+import sys
+
+import numpy
+
+STATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fm_stations.csv')
+
+# Frequencies are stored as integers in units of 100 kHz (97.1 MHz -> 971)
+CHANNELS_PER_MHZ = 10
+
+# "WVUV-FM  103.1 MHz", "KULA-LP-FM  95.1 MHz.", "K246AX-FM  97.1 MHz."
+_CALL_FIELD = re.compile(r'^\s*([^-\s]+)-(\S+)\s+([0-9.]+)\s*MHz', re.IGNORECASE)
+
+# Fixed-width record batches produced by iterStationBatches(). The string
+# widths are minimums; a batch holding longer values gets wider fields.
+BATCH = numpy.dtype([('longitude', 'f8'), ('latitude', 'f8'), ('frequency', 'i4'),
+					 ('callsign', 'U12'), ('service', 'U8'), ('city', 'U40'), ('state', 'U4')])
+BATCH_SIZE = 65536
+
+_stores = {}
+
+
+def toChannel(mhz):
+	return numpy.rint(numpy.asarray(mhz, dtype=numpy.float64) * CHANNELS_PER_MHZ).astype(numpy.int32)
+
+
+class StationStore(object):
+
+	COLUMNS = ('longitude', 'latitude', 'frequency', 'callsign', 'service', 'city', 'state', 'alive')
+
+	def __init__(self, longitude, latitude, frequency, callsign, service, city, state, strings, alive=None):
+		self.longitude = longitude
+		self.latitude = latitude
+		self.frequency = frequency
+		self.callsign = callsign
+		self.service = service
+		self.city = city
+		self.state = state
+		self.alive = numpy.ones(len(longitude), dtype=bool) if alive is None else alive
+		self.strings = strings
+		self._codes = dict((text, code) for code, text in enumerate(strings))
+		self._keys = None
+		self._text = None
+		self.indexes = {}
+
+	def __len__(self):
+		return len(self.longitude)
+
+	def decode(self, codes):
+		return self.strings[codes]
+
+	def encode(self, text):
+		return self._codes.get(text, -1)
+
+	def text(self):
+		if self._text is None or len(self._text) != len(self.strings):
+			self._text = self.strings.astype('U')
+		return self._text
+
+	def station(self, row):
+		return {'Callsign': self.strings[self.callsign[row]],
+				'Service': self.strings[self.service[row]],
+				'Frequency': int(self.frequency[row]) / float(CHANNELS_PER_MHZ),
+				'City': self.strings[self.city[row]],
+				'State': self.strings[self.state[row]],
+				'Coordinates': [float(self.latitude[row]), float(self.longitude[row])],
+				'Row': int(row)}
+
+	# (callsign code, channel) -> live rows. The pair is not unique: KMXT 100.1
+	# and WCFS 105.9, for instance, each have two transmitters.
+	def _rowKeys(self):
+		if self._keys is None:
+			rows = numpy.flatnonzero(self.alive)
+			self._keys = {}
+			for (key, row) in zip(zip(self.callsign[rows].tolist(), self.frequency[rows].tolist()), rows.tolist()):
+				self._keys.setdefault(key, []).append(row)
+		return self._keys
+
+	def rows(self, callsign, mhz):
+		return list(self._rowKeys().get((self.encode(callsign), int(toChannel(mhz))), ()))
+
+	def find(self, callsign, mhz):
+		rows = self._rowKeys().get((self.encode(callsign), int(toChannel(mhz))))
+		return rows[0] if rows else None
+
+	# Current rows of stations saved as (row, callsign, channel), -1 where a
+	# station is gone or its key now names several rows, so files keyed by
+	# row id survive renumbered snapshots
+	def relocate(self, rows, callsigns, channels):
+		rows = numpy.array(rows, dtype=numpy.intp)
+		channels = numpy.asarray(channels)
+		inRange = (rows >= 0) & (rows < len(self))
+		current = numpy.where(inRange, rows, 0)
+		matches = inRange & self.alive[current] & (self.frequency[current] == channels)
+		matches &= self.text()[self.callsign[current]] == numpy.asarray(callsigns, dtype='U')
+		callsigns = list(callsigns)
+		for index in numpy.flatnonzero(~matches):
+			found = self.rows(callsigns[index], channels[index] / float(CHANNELS_PER_MHZ))
+			rows[index] = found[0] if len(found) == 1 else -1
+		return rows
+
+	def _intern(self, texts):
+		added = [text for text in dict.fromkeys(texts) if text not in self._codes]
+		if added:
+			strings = numpy.empty(len(self.strings) + len(added), dtype=object)
+			strings[:len(self.strings)] = self.strings
+			strings[len(self.strings):] = [sys.intern(text) for text in added]
+			for (code, text) in enumerate(added, len(self.strings)):
+				self._codes[text] = code
+			self.strings = strings
+
+	# deletes drop every row under a (callsign, MHz) key. An upsert updates the
+	# row of its key, or the one in its 'Row' when the key names several;
+	# an ambiguous upsert without one raises ValueError before anything changes.
+	def applyDelta(self, upserts=(), deletes=()):
+		upserts = list(upserts)
+		keys = self._rowKeys()
+
+		deletes = [(self.encode(callsign), int(toChannel(mhz))) for (callsign, mhz) in deletes]
+		targets = []
+		for station in upserts:
+			key = (self.encode(station['Callsign']), int(toChannel(station['Frequency'])))
+			rows = [] if key in deletes else keys.get(key, [])
+			row = station.get('Row')
+			if row not in rows:
+				if len(rows) > 1:
+					raise ValueError('%s %s MHz names rows %s; upsert one of them by Row' %
+									 (station['Callsign'], station['Frequency'], rows))
+				row = rows[0] if rows else None
+			targets.append(row)
+
+		deleted = []
+		for key in deletes:
+			deleted.extend(keys.pop(key, ()))
+
+		self._intern([station[field] for station in upserts for field in ('Callsign', 'Service', 'City', 'State')])
+		changed = []
+		length = len(self)
+		for (station, row) in zip(upserts, targets):
+			key = (self.encode(station['Callsign']), int(toChannel(station['Frequency'])))
+			rows = keys.setdefault(key, [])
+			if row is None:
+				# New key, possibly added earlier in this delta
+				row = rows[0] if rows else None
+			if row is None:
+				row = length
+				length += 1
+			if row not in rows:
+				rows.append(row)
+			changed.append(row)
+
+		for name in self.COLUMNS:
+			column = getattr(self, name)
+			grown = numpy.zeros(length, dtype=column.dtype)
+			grown[:len(column)] = column
+			setattr(self, name, grown)
+
+		self.alive[deleted] = False
+		for (row, station) in zip(changed, upserts):
+			(self.latitude[row], self.longitude[row]) = station['Coordinates']
+			self.frequency[row] = toChannel(station['Frequency'])
+			self.callsign[row] = self.encode(station['Callsign'])
+			self.service[row] = self.encode(station['Service'])
+			self.city[row] = self.encode(station['City'])
+			self.state[row] = self.encode(station['State'])
+			self.alive[row] = True
+
+		changed = numpy.unique(numpy.array(changed, dtype=numpy.intp))
+		deleted = numpy.setdiff1d(numpy.array(deleted, dtype=numpy.intp), changed)
+		for index in self.indexes.values():
+			index.update(changed, deleted)
+		return (changed, deleted)
+
+
+def _splitCall(field):
+	match = _CALL_FIELD.match(field)
+	if match is None:
+		return (field.strip(), '', 0)
+	(callsign, service, mhz) = match.groups()
+	return (callsign, service, int(round(float(mhz) * CHANNELS_PER_MHZ)))
+
+
+def _splitCity(field):
+	if ',' not in field:
+		return (field.strip(), '')
+	(city, state) = field.rsplit(',', 1)
+	return (city.strip(), state.strip())
+
+
+def _toBatch(records):
+	fields = []
+	for (index, name) in enumerate(BATCH.names):
+		dtype = BATCH[name]
+		if dtype.kind == 'U':
+			width = max(dtype.itemsize // 4, max(len(record[index]) for record in records))
+			dtype = numpy.dtype('U%d' % width)
+		fields.append((name, dtype))
+	return numpy.array(records, dtype=fields)
+
+
+def iterStationBatches(path=STATIONS_FILE, batchSize=BATCH_SIZE):
+	records = []
+	with open(path, newline='') as fobj:
+		reader = csv.reader(fobj)
+		next(reader, None)
+		for record in reader:
+			if len(record) < 3:
+				continue
+			try:
+				longitude = float(record[0])
+				latitude = float(record[1])
+			except ValueError:
+				continue
+			(callsign, service, channel) = _splitCall(record[2])
+			(city, state) = _splitCity(record[3] if len(record) > 3 else '')
+			records.append((longitude, latitude, channel, callsign, service, city, state))
+			if len(records) == batchSize:
+				yield _toBatch(records)
+				records = []
+	if records:
+		yield _toBatch(records)
+
+
+def parseStations(path=STATIONS_FILE, batchSize=BATCH_SIZE):
+	numeric = ([], [], [])
+	columns = ([], [], [], [])
+	strings = []
+	codes = {}
+
+	def intern(text):
+		code = codes.get(text)
+		if code is None:
+			code = codes[text] = len(strings)
+			strings.append(sys.intern(text))
+		return code
+
+	for batch in iterStationBatches(path, batchSize):
+		for (column, name) in zip(numeric, ('longitude', 'latitude', 'frequency')):
+			column.append(batch[name])
+		for (column, name) in zip(columns, ('callsign', 'service', 'city', 'state')):
+			(unique, inverse) = numpy.unique(batch[name], return_inverse=True)
+			lookup = numpy.array([intern(str(text)) for text in unique], dtype=numpy.int32)
+			column.append(lookup[inverse.ravel()])
+
+	def concatenate(chunks, dtype):
+		return numpy.concatenate(chunks).astype(dtype) if chunks else numpy.empty(0, dtype=dtype)
+
+	table = numpy.empty(len(strings), dtype=object)
+	table[:] = strings
+	return StationStore(concatenate(numeric[0], numpy.float64),
+						concatenate(numeric[1], numpy.float64),
+						concatenate(numeric[2], numpy.int32),
+						*[concatenate(column, numpy.int32) for column in columns],
+						strings=table)
+
+
+def updateStations(upserts=(), deletes=(), path=STATIONS_FILE):
+	from snapshot import appendDelta, encodeDelta
+	upserts = list(upserts)
+	deletes = list(deletes)
+	line = encodeDelta(upserts, deletes)
+	result = getStations(path).applyDelta(upserts, deletes)
+	appendDelta(os.path.abspath(path), line)
+	return result
+
+
+def getStations(path=STATIONS_FILE, snapshot=True):
+	path = os.path.abspath(path)
+	store = _stores.get(path)
+	if store is None:
+		if snapshot:
+			from snapshot import loadStations
+			store = loadStations(path)
+		else:
+			store = parseStations(path)
+		_stores[path] = store
+	return store
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import stations
+from snapshot import logPath
+from stations import getStations, parseStations, updateStations
+
+# KMXT 100.1 has two transmitters, as in the full station list
+STATIONS = '''Long,Lat,Call,
+-158.4147222,56.30166667,KMXT-FM  100.1 MHz,"CHIGNIK,  AK"
+-152.4322222,57.78972222,KMXT-FM  100.1 MHz,"KODIAK,  AK"
+-161.7872222,60.80555556,KYKD-FM  100.1 MHz,"BETHEL,  AK"
+'''
+
+
+class StationStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.path = os.path.join(self.directory, 'stations.csv')
+		with open(self.path, 'w') as fobj:
+			fobj.write(STATIONS)
+
+	def tearDown(self):
+		stations._stores.pop(os.path.abspath(self.path), None)
+		shutil.rmtree(self.directory)
+
+	def test_duplicate_keys(self):
+		store = parseStations(self.path)
+		self.assertEqual(store.rows('KMXT', 100.1), [0, 1])
+		self.assertEqual(store.find('KMXT', 100.1), 0)
+
+	def test_delete_all_duplicates(self):
+		store = parseStations(self.path)
+		(changed, deleted) = store.applyDelta([], [('KMXT', 100.1)])
+		self.assertEqual(deleted.tolist(), [0, 1])
+		self.assertEqual(store.rows('KMXT', 100.1), [])
+		self.assertIsNone(store.find('KMXT', 100.1))
+
+	def test_ambiguous_upsert(self):
+		store = parseStations(self.path)
+		moved = dict(store.station(1), Coordinates=[57.0, -152.0])
+		del moved['Row']
+		with self.assertRaises(ValueError):
+			store.applyDelta([moved, store.station(2)])
+		self.assertEqual(len(store), 3)
+		self.assertEqual(store.latitude.tolist(), [56.30166667, 57.78972222, 60.80555556])
+
+	def test_upsert_by_row(self):
+		store = parseStations(self.path)
+		(changed, deleted) = store.applyDelta([dict(store.station(1), Coordinates=[57.0, -152.0])])
+		self.assertEqual(changed.tolist(), [1])
+		self.assertEqual(store.latitude[[0, 1]].tolist(), [56.30166667, 57.0])
+
+	def test_delete_and_upsert(self):
+		store = parseStations(self.path)
+		replacement = dict(store.station(0), Coordinates=[57.5, -153.0])
+		del replacement['Row']
+		(changed, deleted) = store.applyDelta([replacement], [('KMXT', 100.1)])
+		self.assertEqual(changed.tolist(), [3])
+		self.assertEqual(deleted.tolist(), [0, 1])
+		self.assertEqual(store.rows('KMXT', 100.1), [3])
+		self.assertEqual(store.alive.tolist(), [False, False, True, True])
+
+	def test_replay(self):
+		store = getStations(self.path)
+		updateStations([dict(store.station(numpy.int64(1)), Coordinates=[57.0, -152.0], Row=numpy.int64(1))],
+					   path=self.path)
+		updateStations([], [('KYKD', 100.1)], path=self.path)
+		stations._stores.clear()
+		replayed = getStations(self.path)
+		self.assertIsNot(replayed, store)
+		self.assertEqual(replayed.latitude[1], 57.0)
+		self.assertEqual(replayed.alive.tolist(), [True, True, False])
+		self.assertEqual(replayed.rows('KMXT', 100.1), [0, 1])
+
+	def test_unlogged_delta_not_applied(self):
+		store = getStations(self.path)
+		with self.assertRaises(TypeError):
+			updateStations([dict(store.station(2), City=object())], path=self.path)
+		self.assertEqual(store.strings[store.city[2]], 'BETHEL')
+		self.assertFalse(os.path.exists(logPath(os.path.abspath(self.path))))
+		with self.assertRaises(ValueError):
+			updateStations([dict(store.station(0), Row=None)], path=self.path)
+		self.assertFalse(os.path.exists(logPath(os.path.abspath(self.path))))
+
+
+if __name__ == '__main__':
+	unittest.main()
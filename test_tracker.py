@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from stations import parseStations
+from tracker import PositionTracker, TrackerRDSListener, percentToDb
+
+STATIONS = '''Long,Lat,Call,
+-161.7872222,60.80555556,KYKD-FM  100.1 MHz,"BETHEL,  AK"
+-170.7630556,14.3225,WVUV-FM  103.1 MHz,"FAGAITUA,  AS"
+'''
+
+
+class Radio(object):
+
+	def __init__(self, mhz, percent):
+		self.mhz = mhz
+		self.percent = percent
+
+	def get_frequency(self):
+		return self.mhz * 1000.0
+
+	def get_signal_strength(self):
+		return self.percent
+
+
+class Decoder(object):
+
+	def __init__(self, radio):
+		self.radio = radio
+
+
+class RecordingTracker(PositionTracker):
+
+	def __init__(self):
+		PositionTracker.__init__(self)
+		self.events = []
+
+	def update(self, timestamp, station, rssi):
+		self.events.append((station['Callsign'], rssi))
+		return False
+
+
+class TrackerRDSListenerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		path = os.path.join(self.directory, 'stations.csv')
+		with open(path, 'w') as fobj:
+			fobj.write(STATIONS)
+		self.store = parseStations(path)
+		self.tracker = RecordingTracker()
+		self.listener = TrackerRDSListener(self.tracker, self.store)
+
+	def tearDown(self):
+		self.listener.close()
+		shutil.rmtree(self.directory)
+
+	def test_percent_to_db(self):
+		self.assertEqual(percentToDb(100), 0.0)
+		self.assertAlmostEqual(percentToDb(10), -20.0)
+		self.assertIsNone(percentToDb(0))
+
+	def test_plain_pi(self):
+		# WVUV encodes to 0x8E39 and transmits it unchanged
+		self.listener.on_pi_change(Decoder(Radio(103.1, 10.0)), '0x8e39').result()
+		self.assertEqual(len(self.tracker.events), 1)
+		self.assertEqual(self.tracker.events[0][0], 'WVUV')
+		self.assertAlmostEqual(self.tracker.events[0][1], -20.0)
+
+	def test_linked_pi(self):
+		# KYKD encodes to 0x5067, which is sent as 0xA567
+		self.listener.on_pi_change(Decoder(Radio(100.1, 50.0)), '0xa567').result()
+		self.assertEqual([event[0] for event in self.tracker.events], ['KYKD'])
+
+	def test_no_signal(self):
+		self.listener.on_pi_change(Decoder(Radio(100.1, 0.0)), '0xa567').result()
+		self.assertEqual(self.tracker.events, [])
+
+	def test_unknown_pi(self):
+		self.assertIsNone(self.listener.on_pi_change(Decoder(Radio(100.1, 50.0)), '0x1000'))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,189 @@
+import unittest
+
+import numpy
+
+from benchmark import loopStrongestPoint
+from geodesy import distance
+from pathloss import predict
+from selection import selectStations
+from stations import parseStations
+from triangulation import OBSERVATION, IncrementalTriangulation, getSimplexPower, getStrongestPoint, getVoronaiPoints, \
+	locate_batch
+
+
+def station(lat, lng, signal, callsign=None):
+	result = {'Coordinates': [lat, lng], 'SignalStrength': signal}
+	if callsign is not None:
+		result['Callsign'] = callsign
+	return result
+
+
+class StrongestPointTest(unittest.TestCase):
+
+	def setUp(self):
+		# Four sites with known signals and two hand-built simplices over them
+		self.stations = [station(0.0, 0.0, -40), station(0.0, 1.0, -50),
+						 station(1.0, 0.0, -60), station(1.0, 1.0, -90)]
+		self.simplices = numpy.array([[0, 1, 2], [1, 2, 3]])
+		self.points = numpy.array([[10.0, 20.0], [30.0, 40.0]])
+
+	def test_simplex_power(self):
+		power = getSimplexPower(self.simplices, [-40, -50, -60, -90])
+		numpy.testing.assert_allclose(power, [-50, -200 / 3.0])
+		power = getSimplexPower(self.simplices, [-40, -50, -60, -90], numpy.max)
+		numpy.testing.assert_allclose(power, [-40, -50])
+
+	def test_argmax(self):
+		self.assertEqual(tuple(getStrongestPoint(self.points, self.simplices, self.stations)), (10.0, 20.0))
+		self.stations[3]['SignalStrength'] = 0
+		self.assertEqual(tuple(getStrongestPoint(self.points, self.simplices, self.stations)), (30.0, 40.0))
+
+	def test_top(self):
+		ranking = getStrongestPoint(self.points, self.simplices, self.stations, top=2)
+		self.assertEqual(ranking, [(10.0, 20.0), (30.0, 40.0)])
+		self.assertEqual(getStrongestPoint(self.points, self.simplices, self.stations, top=1), [(10.0, 20.0)])
+
+	def test_nan_center_skipped(self):
+		self.points[0] = numpy.nan
+		self.assertEqual(tuple(getStrongestPoint(self.points, self.simplices, self.stations)), (30.0, 40.0))
+		ranking = getStrongestPoint(self.points, self.simplices, self.stations, top=2)
+		self.assertEqual(ranking, [(30.0, 40.0)])
+
+	def test_all_centers_degenerate(self):
+		self.points[:] = numpy.nan
+		self.assertIsNone(getStrongestPoint(self.points, self.simplices, self.stations))
+		self.assertEqual(getStrongestPoint(self.points, self.simplices, self.stations, top=2), [])
+
+	def test_cosited_strongest_member(self):
+		# A second, stronger service on site 3 lifts that site to -10
+		self.stations.append(station(1.0, 1.0, -10))
+		self.assertEqual(tuple(getStrongestPoint(self.points, self.simplices, self.stations)), (30.0, 40.0))
+		# A weaker one changes nothing
+		self.stations[-1]['SignalStrength'] = -100
+		self.assertEqual(tuple(getStrongestPoint(self.points, self.simplices, self.stations)), (10.0, 20.0))
+
+	def test_two_sites_midpoint(self):
+		stations = [station(41.0, -88.0, -50), station(42.0, -87.0, -60), station(42.0, -87.0, -40)]
+		self.assertEqual(getVoronaiPoints(stations), (41.5, -87.5))
+
+	def test_degenerate_simplices_dropped(self):
+		# Qhull keeps the sliver between the three nearly collinear sites
+		stations = [station(0.0, 0.0, -50), station(1.0, 1e-13, -50), station(2.0, 0.0, -50), station(1.0, 10.0, -50)]
+		(voronaiPts, simplices, coordinates) = getVoronaiPoints(stations)
+		self.assertEqual(len(simplices), 2)
+		self.assertEqual(len(voronaiPts), 2)
+		self.assertTrue(numpy.isfinite(voronaiPts).all())
+		self.assertNotIn([0, 1, 2], numpy.sort(simplices, axis=1).tolist())
+
+	def test_matches_loop(self):
+		random = numpy.random.RandomState(0)
+		coordinates = numpy.column_stack((random.uniform(41, 43, 200), random.uniform(-89, -87, 200)))
+		stations = [station(lat, lng, float(signal))
+					for ((lat, lng), signal) in zip(coordinates.tolist(), random.uniform(-90, -30, 200))]
+		(voronaiPts, simplices, coordinates) = getVoronaiPoints(stations)
+		expected = loopStrongestPoint(voronaiPts, simplices.tolist(), stations)
+		self.assertEqual(tuple(getStrongestPoint(voronaiPts, simplices, stations)), tuple(expected))
+
+
+class IncrementalTriangulationTest(unittest.TestCase):
+
+	def setUp(self):
+		self.triangulation = IncrementalTriangulation()
+		self.stations = [station(0.0, 0.0, -40), station(0.0, 1.0, -50),
+						 station(1.0, 0.0, -60), station(2.0, 2.0, -90)]
+		for member in self.stations:
+			self.triangulation.add(member)
+
+	def test_remove_keeps_cosited(self):
+		# Co-sited stations without callsigns share a site; removing one must not drop the other
+		extra = station(0.0, 0.0, -20)
+		self.triangulation.add(extra)
+		self.triangulation.remove(extra)
+		site = self.triangulation.sites[0]
+		self.assertEqual(len(site['Stations']), 1)
+		self.assertIs(site['Stations'][0], self.stations[0])
+		self.assertEqual(site['SignalStrength'], -40)
+		self.assertEqual(len(self.triangulation.simplices), 2)
+
+	def test_remove_same_callsign(self):
+		first = station(1.0, 1.0, -30, 'WXYZ')
+		second = station(1.0, 1.0, -70, 'WXYZ')
+		self.triangulation.add(first)
+		self.triangulation.add(second)
+		self.triangulation.remove(first)
+		site = self.triangulation.sites[4]
+		self.assertEqual(site['Stations'], [second])
+		self.assertEqual(site['SignalStrength'], -70)
+
+	def test_remove_last_member(self):
+		# Three non-collinear sites remain, which is one triangle
+		self.triangulation.remove(self.stations[3])
+		self.assertEqual(len(self.triangulation.simplices), 1)
+		numpy.testing.assert_allclose(self.triangulation.getStrongestPoint(), (0.5, 0.5))
+		self.triangulation.remove(self.stations[2])
+		self.assertEqual(len(self.triangulation.simplices), 0)
+		self.assertIsNone(self.triangulation.getStrongestPoint())
+
+	def test_three_sites(self):
+		triangulation = IncrementalTriangulation()
+		for member in self.stations[:3]:
+			triangulation.add(member)
+		self.assertEqual(len(triangulation.simplices), 1)
+		(voronaiPts, simplices, coordinates) = getVoronaiPoints(self.stations[:3])
+		numpy.testing.assert_allclose(triangulation.getStrongestPoint(), voronaiPts[0])
+		# The fourth site switches over to Qhull's incremental mode
+		triangulation.add(self.stations[3])
+		self.assertIsNotNone(triangulation.delaunay)
+		self.assertEqual(len(triangulation.simplices), 2)
+
+	def test_three_collinear_sites(self):
+		triangulation = IncrementalTriangulation()
+		for lat in (0.0, 1.0, 2.0):
+			triangulation.add(station(lat, lat, -50))
+		self.assertEqual(len(triangulation.simplices), 0)
+		self.assertIsNone(triangulation.getStrongestPoint())
+
+	def test_remove_by_row(self):
+		triangulation = IncrementalTriangulation()
+		added = [dict(member, Row=row) for (row, member) in enumerate(self.stations)]
+		added.append(dict(self.stations[0], SignalStrength=-20, Row=9))
+		for member in added:
+			triangulation.add(member)
+		# An equal copy, as store.station(row) would return, finds the original
+		triangulation.remove(dict(added[4]))
+		self.assertEqual(triangulation.sites[0]['Stations'], [added[0]])
+		self.assertEqual(triangulation.sites[0]['SignalStrength'], -40)
+		with self.assertRaises(ValueError):
+			triangulation.remove(dict(added[0], Row=7))
+
+	def test_remove_equal_copy(self):
+		self.triangulation.remove(dict(self.stations[1]))
+		self.assertNotIn((0.0, 1.0), self.triangulation._siteKeys)
+		with self.assertRaises(ValueError):
+			self.triangulation.remove(station(5.0, 5.0, -50))
+
+
+class LocateBatchTest(unittest.TestCase):
+
+	def test_used_station_count(self):
+		# Twelve stations around Chicago heard from one spot; subset selection keeps eight sites
+		store = parseStations()
+		rows = numpy.flatnonzero(distance(41.88, -87.63, store.latitude, store.longitude) < 60)[:12]
+		observations = numpy.zeros(len(rows), dtype=OBSERVATION)
+		observations['station'] = rows
+		observations['rssi'] = predict(distance(41.9, -87.7, store.latitude[rows], store.longitude[rows]) ** 2)
+		self.assertEqual(locate_batch(observations, workers=1, store=store)['stations'].tolist(), [12])
+		stations = [station(lat, lng, rssi) for (lat, lng, rssi) in
+					zip(store.latitude[rows].tolist(), store.longitude[rows].tolist(), observations['rssi'].tolist())]
+		selected = selectStations(stations)[0]
+		self.assertLess(len(selected), 12)
+		fixes = locate_batch(observations, method='subset', workers=1, store=store)
+		self.assertEqual(fixes['stations'].tolist(), [len(selected)])
+
+	def test_unknown_method(self):
+		with self.assertRaises(ValueError):
+			locate_batch(numpy.zeros(3, dtype=OBSERVATION), method='gird', store=object())
+
+
+if __name__ == '__main__':
+	unittest.main()
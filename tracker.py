@@ -0,0 +1,207 @@
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+from geodesy import zoneProjection
+from indexes import getPiIndex
+from multilateration import getInitialGuess, solve
+from pathloss import DEFAULT_SIGMA_DB, jacobian, predict, stationParameters
+from stations import CHANNELS_PER_MHZ, getStations
+
+# White acceleration noise for a road vehicle, (km/s^2)^2, and the random
+# walk of the receiver gain offset, dB^2/s
+ACCELERATION_NOISE = 1e-6
+GAIN_NOISE = 0.01
+INITIAL_SPEED_KM = 0.03
+
+# The filter starts once this many distinct stations were heard within
+# INIT_WINDOW seconds, from a multilateration fix over them
+INIT_STATIONS = 3
+INIT_WINDOW = 10.0
+
+# FMRadio.get_signal_strength() is a linear 0-100 percentage of the tuner's
+# full scale; readings are taken as amplitude relative to it. The tracker
+# fits the receiver gain, so only the log scale matters, not the reference.
+FULL_SCALE_DB = 0.0
+
+
+def percentToDb(percent, fullScale=FULL_SCALE_DB):
+	if percent <= 0:
+		return None
+	return fullScale + 20 * math.log10(percent / 100.0)
+
+
+# Extended Kalman filter over [east, north, vEast, vNorth, gain] on a local
+# tangent plane. Every (timestamp, station, rssi) event is a scalar update,
+# so the cost per event does not grow with the history.
+class PositionTracker(object):
+
+	def __init__(self, projection=None, sigma=DEFAULT_SIGMA_DB, accelerationNoise=ACCELERATION_NOISE,
+				 gainNoise=GAIN_NOISE, store=None):
+		self.projection = projection
+		self.sigma = sigma
+		self.accelerationNoise = accelerationNoise
+		self.gainNoise = gainNoise
+		self.store = store
+		self.state = None
+		self.covariance = None
+		self.time = None
+		self._recent = {}
+
+	def _station(self, station):
+		if isinstance(station, dict):
+			return station
+		return (self.store or getStations()).station(int(station))
+
+	def _planar(self, station):
+		(lat, lng) = station['Coordinates']
+		if self.projection is None:
+			self.projection = zoneProjection(lat, lng)
+		(east, north) = self.projection.forward(lat, lng)
+		return numpy.array([east, north])
+
+	def predict(self, timestamp):
+		if self.state is None or timestamp <= self.time:
+			return
+		dt = timestamp - self.time
+		transition = numpy.eye(5)
+		transition[0, 2] = transition[1, 3] = dt
+		noise = numpy.zeros((5, 5))
+		q = self.accelerationNoise
+		for axis in (0, 1):
+			noise[axis, axis] = q * dt ** 3 / 3
+			noise[axis, axis + 2] = noise[axis + 2, axis] = q * dt ** 2 / 2
+			noise[axis + 2, axis + 2] = q * dt
+		noise[4, 4] = self.gainNoise * dt
+		self.state = transition.dot(self.state)
+		self.covariance = transition.dot(self.covariance).dot(transition.T) + noise
+		self.time = timestamp
+
+	def _initialize(self, timestamp):
+		recent = [entry for entry in self._recent.values() if timestamp - entry[0] <= INIT_WINDOW]
+		if len(recent) < INIT_STATIONS:
+			return
+		planar = numpy.array([entry[1] for entry in recent])
+		sigStrength = numpy.array([entry[2] for entry in recent])
+		erp = numpy.array([entry[3] for entry in recent])
+		exponent = numpy.array([entry[4] for entry in recent])
+		(params, covariance, residual, iterations, converged) = solve(planar, sigStrength, erp, exponent,
+																	   getInitialGuess(planar, sigStrength))
+		if not numpy.isfinite(covariance).all():
+			covariance = numpy.diag([100.0, 100.0, 100.0])
+		self.state = numpy.array([params[0], params[1], 0.0, 0.0, params[2]])
+		self.covariance = numpy.diag([0.0, 0.0, INITIAL_SPEED_KM ** 2, INITIAL_SPEED_KM ** 2, 0.0])
+		self.covariance[numpy.ix_([0, 1, 4], [0, 1, 4])] = covariance
+		self.time = timestamp
+		self._recent = {}
+
+	def update(self, timestamp, station, rssi):
+		station = self._station(station)
+		planar = self._planar(station)
+		(erp, exponent) = [float(value[0]) for value in stationParameters([station])]
+
+		if self.state is None:
+			key = station.get('Row', (tuple(station['Coordinates']), station.get('Callsign')))
+			self._recent[key] = (timestamp, planar, float(rssi), erp, exponent)
+			self._initialize(timestamp)
+			return self.state is not None
+
+		self.predict(timestamp)
+		dx = self.state[0] - planar[0]
+		dy = self.state[1] - planar[1]
+		predicted = predict(dx * dx + dy * dy, erp, exponent, self.state[4])
+		h = numpy.zeros(5)
+		h[[0, 1, 4]] = jacobian(dx, dy, exponent)
+
+		spread = self.covariance.dot(h)
+		innovation = h.dot(spread) + self.sigma ** 2
+		gain = spread / innovation
+		self.state = self.state + gain * (rssi - predicted)
+		self.covariance = self.covariance - numpy.outer(gain, spread)
+		return True
+
+	def fix(self, timestamp=None):
+		if self.state is None:
+			return None
+		if timestamp is not None:
+			self.predict(timestamp)
+		(lat, lng) = self.projection.inverse(self.state[0], self.state[1])
+		return {'Time': self.time,
+				'Coordinates': [float(lat), float(lng)],
+				'Velocity': self.state[2:4].copy(),
+				'Gain': float(self.state[4]),
+				'Covariance': self.covariance[:2, :2].copy()}
+
+
+# Consumes (timestamp, station, rssi) events and yields a smoothed fix every
+# 1 / rate seconds of event time once the filter has started. station is a
+# station dict as used by triangulation.py or a station store row id.
+def track(events, rate=1.0, tracker=None):
+	tracker = tracker or PositionTracker()
+	interval = 1.0 / rate
+	due = None
+	for (timestamp, station, rssi) in events:
+		while due is not None and timestamp >= due:
+			yield tracker.fix(due)
+			due += interval
+		if tracker.update(timestamp, station, rssi) and due is None:
+			due = timestamp + interval
+
+
+async def atrack(events, rate=1.0, tracker=None):
+	tracker = tracker or PositionTracker()
+	interval = 1.0 / rate
+	due = None
+	async for (timestamp, station, rssi) in events:
+		while due is not None and timestamp >= due:
+			yield tracker.fix(due)
+			due += interval
+		if tracker.update(timestamp, station, rssi) and due is None:
+			due = timestamp + interval
+
+
+# Duck-typed RDSDecoderListener: register with RDSDecoder.add_listener() and
+# every PI change feeds the tuned station and its signal level into tracker.
+# toDb maps a get_signal_strength() reading to dB and may return None to drop
+# it. Reading the level sleeps about 105 ms, so it runs on executor (a single
+# worker thread by default, which also keeps tracker updates in order)
+# instead of stalling the decoder.
+class TrackerRDSListener(object):
+
+	def __init__(self, tracker=None, store=None, toDb=percentToDb, executor=None):
+		self.tracker = tracker or PositionTracker(store=store)
+		self.store = store
+		self.toDb = toDb
+		self.executor = executor or ThreadPoolExecutor(max_workers=1)
+
+	def _measure(self, radio, timestamp, station):
+		rssi = self.toDb(radio.get_signal_strength())
+		if rssi is not None:
+			self.tracker.update(timestamp, station, rssi)
+
+	def on_pi_change(self, decoder, pi):
+		store = self.store or getStations()
+		rows = getPiIndex(store).rows(pi)
+		if not len(rows):
+			return
+		channel = int(round(decoder.radio.get_frequency() / (1000.0 / CHANNELS_PER_MHZ)))
+		tuned = rows[store.frequency[rows] == channel]
+		row = tuned[0] if len(tuned) else rows[0]
+		return self.executor.submit(self._measure, decoder.radio, time.time(), store.station(row))
+
+	def close(self):
+		self.executor.shutdown()
+
+	def on_ecc_change(self, decoder, ecc):
+		pass
+
+	def on_ps_change(self, decoder, ps):
+		pass
+
+	def on_rt_change(self, decoder, message):
+		pass
+
+	def on_reset(self, decoder):
+		pass
@@ -1,29 +1,89 @@
-from scipy.spatial import Delaunay
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from scipy.spatial import Delaunay, QhullError
+import importlib
 import numpy
+import os
+
+from indexes import getProjectedIndex, getSiteIndex
+from pathloss import DEFAULT_ERP, DEFAULT_EXPONENT
+from stations import getStations
 
 def getMidPoint(points):
 	p1 = points[0]
 	p2 = points[1]
 
-	return math.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
+	return ((p1[0] + p2[0]) / 2.0, (p1[1] + p2[1]) / 2.0)
+
+def getCenterPoints(triangles):
+	triangles = numpy.asarray(triangles, dtype=numpy.float64)
+	origin = triangles[:, 0]
+	b = triangles[:, 1] - origin
+	c = triangles[:, 2] - origin
+
+	d = 2 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+	bb = (b ** 2).sum(axis=1)
+	cc = (c ** 2).sum(axis=1)
+	scale = numpy.maximum(bb, cc)
+	valid = numpy.abs(d) > 1e-12 * scale
+
+	d = numpy.where(valid, d, 1)
+	centers = numpy.column_stack(((c[:, 1] * bb - b[:, 1] * cc) / d, (b[:, 0] * cc - c[:, 0] * bb) / d)) + origin
+	centers[~valid] = numpy.nan
+	return (centers, valid)
 
 def getCenterPoint(vertices):
-	p1 = vertices[0]
-	p2 = vertices[1]
-	p3 = vertices[2]
+	(centers, valid) = getCenterPoints([vertices])
+	return (centers[0, 0], centers[0, 1])
+
+def getSiteIds(stations, store=None):
+	rows = [station.get('Row') for station in stations]
+	if None not in rows:
+		keys = getSiteIndex(store or getStations()).site[rows]
+	else:
+		keys = [tuple(station['Coordinates']) for station in stations]
+	(unique, first, inverse) = numpy.unique(numpy.asarray(keys), axis=0, return_index=True, return_inverse=True)
+	# Sites are numbered in order of their first station
+	rank = numpy.empty(len(first), dtype=numpy.intp)
+	rank[numpy.argsort(first)] = numpy.arange(len(first))
+	return (rank[inverse.ravel()], len(first))
+
+def getSiteSignals(stations, store=None):
+	(site, count) = getSiteIds(stations, store)
+	sigStrength = numpy.array([station.get('SignalStrength', -numpy.inf) for station in stations], dtype=numpy.float64)
+	signals = numpy.full(count, -numpy.inf)
+	numpy.maximum.at(signals, site, sigStrength)
+	return signals
+
+def groupSites(stations, store=None):
+	(groups, count) = getSiteIds(stations, store)
+	order = numpy.argsort(groups, kind='stable')
+	offsets = numpy.searchsorted(groups[order], numpy.arange(count + 1))
 
-	baseMatrix = [[p1[0], p2[0], p3[0]], [p1[1], p2[1], p3[1]], [1, 1, 1]]
-	xMatrix = [[p1[0]**2 + p1[1]**2, p2[0]**2 + p2[1]**2, p3[0]**2 + p3[1]**2], [p1[1], p2[1], p3[1]], [1, 1, 1]]
-	yMatrix = [[p1[0], p2[0], p3[0]], [p1[0]**2 + p1[1]**2, p2[0]**2 + p2[1]**2, p3[0]**2 + p3[1]**2], [1, 1, 1]]
+	sites = []
+	for group in range(count):
+		members = [stations[i] for i in order[offsets[group]:offsets[group + 1]]]
+		site = {'Coordinates': members[0]['Coordinates'], 'Stations': members}
+		strengths = [station['SignalStrength'] for station in members if 'SignalStrength' in station]
+		if strengths:
+			site['SignalStrength'] = max(strengths)
+		if 'Row' in members[0]:
+			site['Row'] = members[0]['Row']
+		sites.append(site)
+	return sites
 
-	h = numpy.linalg.det(xMatrix) / (2 * numpy.linalg.det(baseMatrix))
-	k = numpy.linalg.det(yMatrix) / (2 * numpy.linalg.det(baseMatrix))
+def getPlanarCoordinates(stations, projection, store=None):
+	rows = [station.get('Row') for station in stations]
+	if None not in rows:
+		return getProjectedIndex(store or getStations(), projection).coordinates(rows)
 
-	return (h, k)
+	coordinates = numpy.array([station['Coordinates'] for station in stations], dtype=numpy.float64)
+	return numpy.column_stack(projection.forward(coordinates[:, 0], coordinates[:, 1]))
 
-def getVoronaiPoints(stations):
-	voronaiPts = []
+# Simplices too flat to have a circumcenter are left out of both arrays
+def getVoronaiPoints(stations, projection=None):
 	coordinates = []
+	stations = groupSites(stations)
 	for station in stations:
 		coordinates.append(station['Coordinates'])
 
@@ -31,34 +91,280 @@ def getVoronaiPoints(stations):
 		return (coordinates[0][0], coordinates[0][1])
 	elif (len(coordinates) == 2):
 		return getMidPoint(coordinates)
+	elif projection is not None:
+		planar = getPlanarCoordinates(stations, projection)
+		simplices = Delaunay(planar).simplices
+		(centers, valid) = getCenterPoints(planar[simplices])
+		voronaiPts = numpy.column_stack(projection.inverse(centers[valid, 0], centers[valid, 1]))
+
+		return (voronaiPts,simplices[valid],coordinates)
 	else:
 		simplices = Delaunay(coordinates).simplices
+		(voronaiPts, valid) = getCenterPoints(numpy.asarray(coordinates, dtype=numpy.float64)[simplices])
 
-		for simplice in simplices:
-			voronaiPts.append(getCenterPoint([coordinates[simplice[0]], coordinates[simplice[1]], coordinates[simplice[2]]]))
+		return (voronaiPts[valid],simplices[valid],coordinates)
 
-		return (voronaiPts,simplices,coordinates)
+def getSimplexPower(simplices, sigStrength, aggregate=numpy.mean):
+	return aggregate(numpy.asarray(sigStrength, dtype=numpy.float64)[simplices], axis=1)
 
-def getStrongestPoint(voronaiPoints,simplices,stations):
-	sigStrength = []
-	avgSigPower = []
-	for station in stations:
-		sigStrength.append(station['SignalStrength'])
+# Degenerate simplices have no finite center and are never returned; None,
+# or an empty ranking for top, when no simplex has one
+def getStrongestPoint(voronaiPoints, simplices, stations, aggregate=numpy.mean, top=None):
+	avgSigPower = getSimplexPower(simplices, getSiteSignals(stations), aggregate)
+	voronaiPoints = numpy.asarray(voronaiPoints, dtype=numpy.float64)
+	valid = numpy.flatnonzero(numpy.isfinite(voronaiPoints).all(axis=1))
 
-	for simple in simplices:
-		avgSigPower.append((sigStrength[simplices[1]] + sigStrength[simplices[2]] + sigStrength[simplices[3]])/3)
+	if top is not None:
+		ranking = valid[numpy.argsort(-avgSigPower[valid], kind='stable')[:top]]
+		return [(lat, lng) for (lat, lng) in voronaiPoints[ranking].tolist()]
 
-	for sigPower in avgSigPower:
-		max = 0
-		index = 0
-		if sigpower > max:
-			max = sigpower
-			maxIndex = index
-		index += 1
-
-	(lat, lng) = voronaiPoints[maxIndex]
+	if not len(valid):
+		return None
+	(lat, lng) = voronaiPoints[valid[numpy.argmax(avgSigPower[valid])]]
 	return (lat,lng)
 
+OBSERVATION = numpy.dtype([('epoch', 'i8'), ('station', 'i8'), ('rssi', 'f8')])
+FIX = numpy.dtype([('epoch', 'i8'), ('latitude', 'f8'), ('longitude', 'f8'), ('gain', 'f8'),
+				   ('residual', 'f8'), ('gdop', 'f8'), ('stations', 'i4'), ('ok', '?')])
+# locate_batch() method -> module providing locate(); imported in the workers
+LOCATORS = {'multilateration': 'multilateration', 'grid': 'gridlocator', 'subset': 'selection', 'ransac': 'ransac'}
+
+# Station latitude, longitude, erp and exponent per row, shared read-only
+# with the locate_batch() workers
+_shared = {}
+
+def _attachStations(name, count):
+	memory = shared_memory.SharedMemory(name=name)
+	_shared['memory'] = memory
+	_shared['coordinates'] = numpy.ndarray((count, 4), dtype=numpy.float64, buffer=memory.buf)
+
+def _locateShard(epochs, offsets, stationIds, sigStrength, method):
+	locate = importlib.import_module(LOCATORS[method]).locate
+	coordinates = _shared['coordinates']
+
+	fixes = numpy.zeros(len(epochs), dtype=FIX)
+	fixes['epoch'] = epochs
+	fixes['latitude'] = numpy.nan
+	fixes['longitude'] = numpy.nan
+	fixes['gdop'] = numpy.nan
+	for index in range(len(epochs)):
+		(start, end) = (offsets[index], offsets[index + 1])
+		stations = [{'Coordinates': [lat, lng], 'Erp': erp, 'Exponent': exponent, 'SignalStrength': rssi}
+					for ((lat, lng, erp, exponent), rssi) in zip(coordinates[stationIds[start:end]].tolist(),
+																  sigStrength[start:end].tolist())]
+		fixes['stations'][index] = len(stations)
+		try:
+			fix = locate(stations)
+		except (numpy.linalg.LinAlgError, ValueError):
+			continue
+		(fixes['latitude'][index], fixes['longitude'][index]) = fix['Coordinates']
+		# The subset and RANSAC locators report the stations they actually used
+		fixes['stations'][index] = len(fix.get('Stations', fix.get('Inliers', stations)))
+		fixes['gain'][index] = fix['Gain']
+		fixes['residual'][index] = fix.get('Residual', numpy.nan)
+		fixes['gdop'][index] = fix.get('GDOP', numpy.nan)
+		fixes['ok'][index] = fix.get('Converged', True) and numpy.isfinite(fix['Coordinates']).all()
+	return fixes
+
+# observations holds one (epoch, station row id, rssi) record per reading.
+# Epochs are sharded across a process pool that reads station coordinates
+# from shared memory; one fix per epoch comes back, ordered by epoch. Pass a
+# calibration.Calibration to use fitted per-station path-loss parameters.
+def locate_batch(observations, method='multilateration', workers=None, shardEpochs=2048, store=None,
+				 calibration=None):
+	if method not in LOCATORS:
+		raise ValueError('unknown method %r, expected one of %s' % (method, ', '.join(sorted(LOCATORS))))
+	store = store or getStations()
+	observations = numpy.asarray(observations)
+	order = numpy.argsort(observations['epoch'], kind='stable')
+	epochIds = observations['epoch'][order]
+	stationIds = observations['station'][order].astype(numpy.intp)
+	sigStrength = observations['rssi'][order].astype(numpy.float64)
+
+	(epochs, starts) = numpy.unique(epochIds, return_index=True)
+	offsets = numpy.append(starts, len(epochIds))
+	shards = [(epochs[first:first + shardEpochs], offsets[first:first + shardEpochs + 1] - offsets[first],
+			   stationIds[offsets[first]:offsets[min(first + shardEpochs, len(epochs))]],
+			   sigStrength[offsets[first]:offsets[min(first + shardEpochs, len(epochs))]], method)
+			  for first in range(0, len(epochs), shardEpochs)]
+
+	if calibration is None:
+		(erp, exponent) = (numpy.full(len(store), DEFAULT_ERP), numpy.full(len(store), DEFAULT_EXPONENT))
+	else:
+		(erp, exponent) = calibration.parameters(numpy.arange(len(store)))
+	coordinates = numpy.column_stack((store.latitude, store.longitude, erp, exponent))
+	workers = workers or os.cpu_count() or 1
+	if workers == 1 or len(shards) <= 1:
+		_shared['coordinates'] = coordinates
+		results = [_locateShard(*shard) for shard in shards]
+	else:
+		memory = shared_memory.SharedMemory(create=True, size=max(coordinates.nbytes, 1))
+		try:
+			numpy.ndarray(coordinates.shape, dtype=numpy.float64, buffer=memory.buf)[:] = coordinates
+			with ProcessPoolExecutor(max_workers=min(workers, len(shards)), initializer=_attachStations,
+									 initargs=(memory.name, len(coordinates))) as pool:
+				results = list(pool.map(_locateShard, *zip(*shards)))
+		finally:
+			memory.close()
+			memory.unlink()
+
+	if not results:
+		return numpy.zeros(0, dtype=FIX)
+	return numpy.concatenate(results)
+
+
+# Keeps a Delaunay triangulation of the heard sites up to date as stations
+# arrive during a scan. Insertions go through Qhull's incremental mode and
+# only simplices that did not exist before get a new circumcenter and signal
+# average. Qhull cannot delete points, so removing a site's last station
+# rebuilds the triangulation from the remaining sites.
+class IncrementalTriangulation(object):
+
+	def __init__(self, projection=None):
+		self.projection = projection
+		self.sites = []
+		self._siteKeys = {}
+		self._points = []
+		self._signal = []
+		self._order = []
+		self._pending = []
+		self.delaunay = None
+		self._reset()
+
+	def _reset(self):
+		self.simplices = numpy.empty((0, 3), dtype=numpy.intp)
+		self.vertexSites = numpy.empty((0, 3), dtype=numpy.intp)
+		self.centers = numpy.empty((0, 2))
+		self.voronaiPts = numpy.empty((0, 2))
+		self.average = numpy.empty(0)
+		self._keys = numpy.empty(0, dtype=numpy.int64)
+
+	def _planar(self, station):
+		if self.projection is None:
+			return numpy.asarray(station['Coordinates'], dtype=numpy.float64)
+		return getPlanarCoordinates([station], self.projection)[0]
+
+	def _siteSignal(self, site):
+		strengths = [station['SignalStrength'] for station in self.sites[site]['Stations'] if 'SignalStrength' in station]
+		if strengths:
+			self.sites[site]['SignalStrength'] = max(strengths)
+		else:
+			self.sites[site].pop('SignalStrength', None)
+		self._signal[site] = max(strengths) if strengths else numpy.nan
+
+	def _start(self, sites):
+		self.delaunay = None
+		self._order = []
+		self._pending = list(sites)
+		self._reset()
+		points = [self._points[site] for site in sites]
+		if len(points) >= 4:
+			try:
+				self.delaunay = Delaunay(points, incremental=True)
+			except QhullError:
+				# All collinear; wait for another site
+				pass
+		if self.delaunay is not None:
+			self._order = list(sites)
+			self._pending = []
+			self._update(self.delaunay.simplices)
+		elif len(points) == 3 and getCenterPoints([points])[1][0]:
+			# Qhull's incremental mode needs four points to start, so three sites
+			# keep their one triangle here until the fourth arrives
+			self._order = list(sites)
+			self._update(numpy.array([[0, 1, 2]], dtype=numpy.intp))
+
+	def add(self, station):
+		key = tuple(station['Coordinates'])
+		site = self._siteKeys.get(key)
+		if site is not None:
+			self.sites[site]['Stations'].append(station)
+			self._siteSignal(site)
+			touched = (self.vertexSites == site).any(axis=1)
+			signal = numpy.asarray(self._signal)
+			self.average[touched] = signal[self.vertexSites[touched]].mean(axis=1)
+			return site
+
+		site = self._siteKeys[key] = len(self.sites)
+		self.sites.append({'Coordinates': station['Coordinates'], 'Stations': [station]})
+		self._points.append(self._planar(station))
+		self._signal.append(numpy.nan)
+		self._siteSignal(site)
+		if self.delaunay is None:
+			self._start(self._pending + [site])
+		else:
+			self.delaunay.add_points([self._points[site]])
+			self._order.append(site)
+			self._update(self.delaunay.simplices)
+		return site
+
+	# Stations are matched by 'Row' when both carry one, otherwise by identity
+	# and then equality, so a fresh store.station(row) removes what was added
+	def remove(self, station):
+		site = self._siteKeys.get(tuple(station['Coordinates']))
+		members = [] if site is None else self.sites[site]['Stations']
+		if 'Row' in station:
+			matches = [index for (index, member) in enumerate(members) if member.get('Row') == station['Row']]
+		else:
+			matches = [index for (index, member) in enumerate(members) if member is station] or \
+				[index for (index, member) in enumerate(members) if member == station]
+		if not matches:
+			raise ValueError('station %r is not in the triangulation' % (station.get('Callsign', station['Coordinates']),))
+		del members[matches[0]]
+		if members:
+			self._siteSignal(site)
+			touched = (self.vertexSites == site).any(axis=1)
+			signal = numpy.asarray(self._signal)
+			self.average[touched] = signal[self.vertexSites[touched]].mean(axis=1)
+			return
+		del self._siteKeys[tuple(station['Coordinates'])]
+		active = [other for other in (self._order or self._pending) if other != site]
+		self._start(active)
+
+	def _update(self, simplices):
+		order = numpy.asarray(self._order, dtype=numpy.intp)
+		vertexSites = order[simplices]
+		ordered = numpy.sort(vertexSites, axis=1).astype(numpy.int64)
+		keys = (ordered[:, 0] << 42) | (ordered[:, 1] << 21) | ordered[:, 2]
+
+		centers = numpy.empty((len(keys), 2))
+		voronaiPts = numpy.empty((len(keys), 2))
+		average = numpy.empty(len(keys))
+		known = numpy.zeros(len(keys), dtype=bool)
+		if len(self._keys):
+			previous = self._keys
+			sorter = numpy.argsort(previous)
+			slots = numpy.searchsorted(previous, keys, sorter=sorter)
+			slots = sorter[numpy.minimum(slots, len(previous) - 1)]
+			known = previous[slots] == keys
+			centers[known] = self.centers[slots[known]]
+			voronaiPts[known] = self.voronaiPts[slots[known]]
+			average[known] = self.average[slots[known]]
+
+		fresh = ~known
+		if fresh.any():
+			points = numpy.asarray(self._points)
+			(centers[fresh], valid) = getCenterPoints(points[vertexSites[fresh]])
+			if self.projection is None:
+				voronaiPts[fresh] = centers[fresh]
+			else:
+				voronaiPts[fresh] = numpy.column_stack(self.projection.inverse(centers[fresh, 0], centers[fresh, 1]))
+			average[fresh] = numpy.asarray(self._signal)[vertexSites[fresh]].mean(axis=1)
+
+		(self.simplices, self.vertexSites, self._keys) = (simplices, vertexSites, keys)
+		(self.centers, self.voronaiPts, self.average) = (centers, voronaiPts, average)
+
+	def getVoronaiPoints(self):
+		coordinates = [self.sites[site]['Coordinates'] for site in self._order]
+		return (self.voronaiPts, self.simplices, coordinates)
+
+	def getStrongestPoint(self):
+		average = numpy.where(numpy.isfinite(self.voronaiPts).all(axis=1), self.average, numpy.nan)
+		if not len(average) or numpy.isnan(average).all():
+			return None
+		(lat, lng) = self.voronaiPts[numpy.nanargmax(average)]
+		return (lat, lng)
+
 
 if __name__ == '__main__':
 	stationList = []